@@ -1,7 +1,5 @@
 import os
-
-from managers.detection_manager import DetectionManager
-from managers.tracking_manager import TrackingManager
+import argparse
 
 """
 
@@ -19,8 +17,26 @@ from managers.tracking_manager import TrackingManager
 
 if __name__ == '__main__':
 
-    input_file = input('Path to the file/folder : ')
-    if not os.path.isfile(input_file) or not os.path.isdir(input_file):
+    parser = argparse.ArgumentParser(description="Simple tool to help annotate data")
+    parser.add_argument("input_file", nargs="?", help="file/folder (or http(s) URL) to annotate, asked interactively when omitted")
+    parser.add_argument("--mode", choices=["detection", "tracking"], default="detection")
+    parser.add_argument("--start-frame", type=int, default=0)
+    parser.add_argument("--multi-track", action="store_true", help="tracking : annotate several cells in one pass")
+    parser.add_argument("--classes", nargs="+", default=["object"], help="detection : class names")
+    parser.add_argument("--attributes", nargs="*", default=[], help="detection : attribute names")
+    parser.add_argument("--project", help="shared project directory (see services/project_store.py)")
+    parser.add_argument("--annotator", help="name of the annotator in the shared project")
+    parser.add_argument("--cache-raw-mb", type=int, default=256, help="decoded frames kept in memory")
+    parser.add_argument("--cache-compressed-mb", type=int, default=512, help="compressed frames kept in memory")
+    parser.add_argument("--cache-codec", choices=["zlib", "lz4", "png"], default="zlib")
+    parser.add_argument("--record", help="record the session events to this file (see services/session_replay.py)")
+    args = parser.parse_args()
+
+    input_file = args.input_file
+    if input_file is None:
+        input_file = input('Path to the file/folder : ')
+    is_url = input_file.startswith("http://") or input_file.startswith("https://")
+    if not is_url and not os.path.isfile(input_file) and not os.path.isdir(input_file):
         print(f'Given path is not a file nor directory')
         exit(1)
 
@@ -34,5 +50,26 @@ if __name__ == '__main__':
     print('- S to save all validated objects')
     print('- Z to undo last rectangle')
 
-    detector = DetectionManager(input_file)
-    detector.run()
+    # managers (and with them numpy / OpenCV) are only imported once the arguments are known
+    from services.frame_cache import FrameCache
+    frame_cache = FrameCache(args.cache_raw_mb << 20, args.cache_compressed_mb << 20, codec=args.cache_codec)
+
+    recorder = None
+    if args.record is not None:
+        from services.session_recorder import SessionRecorder
+        recorder = SessionRecorder(args.record)
+
+    store = None
+    if args.project is not None:
+        from services.project_store import ProjectStore
+        store = ProjectStore(args.project, annotator=args.annotator)
+
+    if args.mode == "tracking":
+        from managers.tracking_manager import TrackingManager
+        manager = TrackingManager(input_file, args.start_frame, multi_track=args.multi_track, store=store,
+                                  frame_cache=frame_cache, recorder=recorder)
+    else:
+        from managers.detection_manager import DetectionManager
+        manager = DetectionManager(input_file, args.start_frame, classes=args.classes, attributes=args.attributes,
+                                   store=store, frame_cache=frame_cache, recorder=recorder)
+    manager.run()
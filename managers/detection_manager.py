@@ -1,24 +1,51 @@
 import numpy as np
 import cv2
+import os
 import json
 from datetime import datetime
 
 from services.file_service import open_file
+from services.frame_cache import FrameCache
+from services.display_service import DisplayBuffers
+from services.label_service import LabelTable, AttributeTable, ObjectArray
 
 
 class DetectionManager(object):
-    def __init__(self, file, starting_frame=0):
+    def __init__(self, file, starting_frame=0, classes=("object",), attributes=(), store=None, claim_size=50,
+                 frame_cache=None, recorder=None):
         self.list_detections = {}
-        self.list_objects = []
+        self.list_objects = ObjectArray()
+        self.frame_indexes = {}
 
-        self.reader = open_file(self, file)
+        self.classes = LabelTable(classes)
+        self.attributes = AttributeTable(attributes)
+        self.current_class = 0
+        self.current_attributes = 0
+
+        self.reader = open_file(self, file, background=True)
+        self.frame_cache = frame_cache if frame_cache is not None else FrameCache()
+
+        # optional SessionRecorder, every GUI event is recorded so the session can be replayed
+        self.recorder = recorder
+        if self.recorder is not None:
+            self.recorder.record_header(type(self).__name__, file=file, starting_frame=starting_frame,
+                                        classes=list(classes), attributes=list(attributes), claim_size=claim_size)
 
         self.starting_frame = starting_frame
         self.current_frame = self.starting_frame
+
+        # optional shared ProjectStore, frames are claimed by chunks of claim_size so annotators never overlap
+        self.store = store
+        self.claim_size = claim_size
+        self.claimed_range = None
+        self.claim_current_frame()
         self.current_image = np.zeros((1,1))
         self.image_for_drawings = np.zeros((1,1))
+        self.display_buffers = DisplayBuffers()
+        self.frame_pending = False
 
         self.autosave_interval = 10
+        self.save_folder = "."
 
         self.display_current_points = True
         self.display_other_points = True
@@ -30,6 +57,12 @@ class DetectionManager(object):
         self.color_current = [200, 0, 0]
         self.color_others = [0, 0, 200]
 
+        # per class code : drawing color, visibility and {frame_reference: amount of boxes}
+        self.class_colors = [self.color_others]
+        self.class_visible = np.ones(0, dtype=bool)
+        self.class_frames = []
+        self.sync_classes()
+
         self.running = True
 
         self.alpha = 1.0
@@ -38,27 +71,125 @@ class DetectionManager(object):
 
         self.frame_reference = None
         self.previous_frame_reference = None
-        self.prepare_frame()
-        self.h, self.w = self.current_image.shape[:2]
+        self.h, self.w = 0, 0
 
     def save(self, suffix=None, include_current=False):
-        file_name = f"./save_{str(datetime.now())[:19].replace(':', '-').replace(' ', '_')}.json"
+        file_name = os.path.join(self.save_folder, f"save_{str(datetime.now())[:19].replace(':', '-').replace(' ', '_')}.json")
         if suffix is not None:
             file_name = file_name[:-4] + f"_{suffix}.json"
         else:
             print(f"saving as : {file_name}")
 
-        dict_to_save = self.list_detections.copy()
+        dict_to_save = {k: v.to_list(self.classes, self.attributes) for k, v in self.list_detections.items()}
 
         if include_current:
-            dict_to_save[self.frame_reference] = self.list_objects
+            dict_to_save[self.frame_reference] = self.list_objects.to_list(self.classes, self.attributes)
 
         with open(file_name, 'w') as json_file:
-            json.dump(dict_to_save, json_file, indent=2)
+            output = self.recorder.saving(json_file) if self.recorder is not None else json_file
+            json.dump(dict_to_save, output, indent=2)
+        if self.recorder is not None:
+            self.recorder.record_save(output)
 
     def load(self, file_name):
         with open(file_name, 'r') as json_file:
-            self.list_detections = json.load(json_file)
+            data = json.load(json_file)
+
+        self.list_detections = {k: ObjectArray.from_list(v, self.classes, self.attributes) for k, v in data.items()}
+        self.sync_classes()
+
+        self.class_frames = [{} for _ in range(len(self.classes))]
+        for frame_reference, objects in self.list_detections.items():
+            self.index_frame(frame_reference, objects)
+            # saves only hold references, the store needs the frame index for its frame and range queries
+            if frame_reference not in self.frame_indexes:
+                frame_idx = self.reader.frame_index(frame_reference)
+                if frame_idx is not None:
+                    self.frame_indexes[frame_reference] = frame_idx
+        self.commit_all_to_store()
+
+    def sync_classes(self):
+        # extends the per class structures after new classes got interned
+        class_count = len(self.classes)
+        hues = np.linspace(0, 180, num=max(class_count, 1), endpoint=False).astype(np.uint8)
+        palette = cv2.cvtColor(np.stack([hues, np.full_like(hues, 255), np.full_like(hues, 220)], axis=-1)[None],
+                               cv2.COLOR_HSV2BGR)[0]
+        for class_id in range(len(self.class_colors), class_count):
+            self.class_colors.append([int(c) for c in palette[class_id]])
+
+        visible = np.ones(class_count, dtype=bool)
+        visible[:len(self.class_visible)] = self.class_visible
+        self.class_visible = visible
+
+        self.class_frames += [{} for _ in range(len(self.class_frames), class_count)]
+
+    def add_class(self, name):
+        class_id = self.classes.intern(name)
+        self.sync_classes()
+        return class_id
+
+    def index_frame(self, frame_reference, objects, remove=False):
+        counts = objects.class_counts(len(self.classes))
+        for class_id in np.flatnonzero(counts):
+            if remove:
+                self.class_frames[class_id].pop(frame_reference, None)
+            else:
+                self.class_frames[class_id][frame_reference] = int(counts[class_id])
+
+    def frames_with_class(self, name):
+        class_id = self.classes.codes.get(name)
+        if class_id is None:
+            return []
+        return list(self.class_frames[class_id])
+
+    def select_class(self, class_id):
+        if 0 <= class_id < len(self.classes):
+            self.current_class = class_id
+            self.refresh_status()
+            # keys 1 to 9 select a class too, the trackbars must follow so they do not edit the previous class color
+            class_color = self.class_colors[self.current_class]
+            if len(self.classes) > 1:
+                cv2.setTrackbarPos("class", "Controls", self.current_class)
+            cv2.setTrackbarPos("class color R", "Controls", class_color[2])
+            cv2.setTrackbarPos("class color G", "Controls", class_color[1])
+            cv2.setTrackbarPos("class color B", "Controls", class_color[0])
+
+    def toggle_attribute(self, attribute_id, state):
+        if state:
+            self.current_attributes |= 1 << attribute_id
+        else:
+            self.current_attributes &= ~(1 << attribute_id)
+        self.refresh_status()
+
+    def set_class_visible(self, class_id, visible):
+        self.class_visible[class_id] = visible
+        self.display_frame()
+
+    def refresh_status(self):
+        attributes = ", ".join(self.attributes.decode(self.current_attributes))
+        cv2.displayStatusBar("img", f"class : {self.classes.name(self.current_class)} - attributes : {attributes}", 0)
+
+    def commit_all_to_store(self):
+        if self.store is None:
+            return
+        self.store.bulk_commit_detections(
+            (self.frame_indexes.get(frame_reference), frame_reference, objects.to_list(self.classes, self.attributes))
+            for frame_reference, objects in self.list_detections.items()
+        )
+
+    def claim_current_frame(self):
+        if self.store is None:
+            return
+        if self.claimed_range is not None and self.claimed_range[0] <= self.current_frame <= self.claimed_range[1]:
+            return
+        self.claimed_range = self.store.claim_frames(self.current_frame, self.claim_size)
+        if self.claimed_range[0] != self.current_frame:
+            print(f"Frames {self.current_frame} to {self.claimed_range[0] - 1} are claimed by other annotators, skipping")
+        self.current_frame = self.claimed_range[0]
+
+    def release_claims(self):
+        if self.store is not None:
+            self.store.release_frames(self.current_frame)
 
     def reset_rect(self):
         self.mouse_drag = {
@@ -74,9 +205,10 @@ class DetectionManager(object):
 
     def undo(self):
         if len(self.list_objects) > 0:
-            self.list_objects = self.list_objects[:-1]
+            self.list_objects.pop()
         elif len(list(self.list_detections)) > 0:
             self.list_objects = self.list_detections[self.previous_frame_reference].copy()
+            self.index_frame(self.previous_frame_reference, self.list_objects, remove=True)
             del self.list_detections[self.previous_frame_reference]
             self.current_frame -= 1
         self.reset_rect()
@@ -84,28 +216,34 @@ class DetectionManager(object):
         self.display_frame()
 
     def next(self, what):
+        if self.frame_pending:
+            # the displayed frame is not the current one yet
+            return
         if what == "object":
             # validate rect
             if self.mouse_drag["end"][0] >= 0 and self.mouse_drag["end"][1] >= 0:
-                dict_to_add = {
-                    "rect": {
-                        "start": (int(self.mouse_drag["start"][0]), int(self.mouse_drag["start"][1])),
-                        "end": (int(self.mouse_drag["end"][0]), int(self.mouse_drag["end"][1]))
-                    }
-                }
-                self.list_objects.append(dict_to_add)
+                self.list_objects.append(self.mouse_drag["start"], self.mouse_drag["end"],
+                                         self.current_class, self.current_attributes)
 
                 self.reset_rect()
                 self.display_frame()
             else:
                 return self.next("frame")
         elif what == "frame":
+            if self.frame_reference in self.list_detections:
+                self.index_frame(self.frame_reference, self.list_detections[self.frame_reference], remove=True)
             self.list_detections[self.frame_reference] = self.list_objects.copy()
-            self.list_objects = []
+            self.frame_indexes[self.frame_reference] = self.current_frame
+            self.index_frame(self.frame_reference, self.list_objects)
+            if self.store is not None:
+                self.store.commit_detections(self.current_frame, self.frame_reference,
+                                             self.list_objects.to_list(self.classes, self.attributes))
+            self.list_objects = ObjectArray()
 
             self.reset_rect()
 
             self.current_frame += 1
+            self.claim_current_frame()
             self.prepare_frame()
             self.display_frame()
 
@@ -127,9 +265,18 @@ class DetectionManager(object):
         elif idx == 3:
             self.mouse_drag["end"] = np.array([x, y])
 
+    def record_event(self, kind, *args):
+        if self.recorder is not None:
+            self.recorder.record(kind, *args)
+
+    def reader_callback(self, what, value):
+        self.record_event("reader", what, value)
+        self.reader.signal_from_gui(what, value=value)
+
     def mouse_callback(self, event, x, y, flags, userdata, **kargs):
         if bool(kargs):
             print(f"mouseCallback - Extra arguments {kargs}")
+        self.record_event("mouse", event, x, y, flags)
 
         if event == cv2.EVENT_MOUSEMOVE:
             if flags & cv2.EVENT_FLAG_RBUTTON:
@@ -185,6 +332,7 @@ class DetectionManager(object):
     def track_callback(self, what, value, **kargs):
         if bool(kargs):
             print(f"trackCallback - Extra arguments {kargs}")
+        self.record_event("track", what, value)
         if what == 'alpha':
             self.alpha = value * 0.01
             self.prepare_frame()
@@ -206,17 +354,21 @@ class DetectionManager(object):
                 elif what[-1] == 'b':
                     self.color_current[0] = value
             elif what.startswith("color_other_"):
+                class_color = self.class_colors[self.current_class]
                 if what[-1] == 'r':
-                    self.color_others[2] = value
+                    class_color[2] = value
                 elif what[-1] == 'g':
-                    self.color_others[1] = value
+                    class_color[1] = value
                 elif what[-1] == 'b':
-                    self.color_others[0] = value
+                    class_color[0] = value
             self.display_frame()
+        elif what == 'class':
+            self.select_class(value)
 
     def button_callback(self, state, data, **kargs):
         if bool(kargs):
             print(f"button_callback - Extra arguments {kargs}")
+        self.record_event("button", state, data)
         if data == "save":
             self.save()
         elif data == 'save_include':
@@ -225,6 +377,10 @@ class DetectionManager(object):
             self.undo()
         elif data == "quit":
             self.save("onquit")
+            if self.recorder is not None:
+                self.recorder.close()
+            print(f"frame cache : {self.frame_cache.stats()}")
+            self.release_claims()
             self.running = False
             exit(0)
         elif data == 'next object':
@@ -240,36 +396,77 @@ class DetectionManager(object):
         elif data == "display_other":
             self.display_other_points = state == 1
             self.display_frame()
+        elif data.startswith("attribute_"):
+            self.toggle_attribute(int(data[len("attribute_"):]), state == 1)
+        elif data.startswith("show_class_"):
+            self.set_class_visible(int(data[len("show_class_"):]), state == 1)
+
+    def key_callback(self, key):
+        self.record_event("key", key)
+        if key == 32:  # SPACE
+            self.next('object')
+        elif key == 115:  # S
+            self.save()
+        elif key == 122:  # Z
+            self.undo()
+        elif 49 <= key <= 57:  # 1 to 9
+            self.select_class(key - 49)
 
     def force_refresh(self):
+        # reader settings changed, cached frames are outdated
+        self.frame_cache.clear()
         self.prepare_frame()
         self.display_frame()
 
+    def frame_ready(self, frame_idx):
+        # the reader decodes in the background, never wait in a callback : the progress is shown and run() prepares
+        # the frame again once it is available
+        if self.reader.error is not None:
+            raise self.reader.error
+        if self.reader.is_frame_ready(frame_idx):
+            if self.frame_pending:
+                cv2.displayOverlay("img", "", 1)
+                self.frame_pending = False
+            return True
+        cv2.displayOverlay("img", f"Loading ... {100 * self.reader.progress:.0f} %", 0)
+        self.frame_pending = True
+        return False
+
+    def read_frame(self, frame_idx):
+        cached = self.frame_cache.get(frame_idx)
+        if cached is None:
+            cached = self.reader.get_frame(frame_idx)
+            self.frame_cache.put(frame_idx, *cached)
+        return cached
+
     def prepare_frame(self):
         frame_idx = self.current_frame
+        if not self.frame_ready(frame_idx):
+            return
         self.previous_frame_reference = self.frame_reference
-        image, self.frame_reference = self.reader.get_frame(frame_idx)
+        image, self.frame_reference = self.read_frame(frame_idx)
 
-        self.current_image = image.copy()
-        if len(image.shape) == 2:
-            self.current_image = cv2.cvtColor(self.current_image, cv2.COLOR_GRAY2BGR)
-
-        self.image_for_drawings = np.clip(
-            ((((self.current_image.astype(np.float64) / 255.) ** self.gamma) * 255.) * self.alpha + self.beta),
-            0,
-            255
-        ).astype(np.uint8)
+        # no copy, grey frames stay single channel until display_frame expands them for the overlays
+        self.current_image = image
+        self.image_for_drawings = self.display_buffers.adjust(image, self.alpha, self.beta, self.gamma)
+        self.h, self.w = self.current_image.shape[:2]
 
     def display_frame(self):
         frame_idx = self.current_frame
 
-        image_to_show = self.image_for_drawings.copy()
+        image_to_show = self.display_buffers.to_display()
 
-        if self.display_other_points:
-            for object in self.list_objects:
-                rect = object['rect']
-                image_to_show = cv2.rectangle(image_to_show, tuple(rect["start"]),
-                                              tuple(rect["end"]), tuple(self.color_others), 1)
+        count = len(self.list_objects)
+        if self.display_other_points and count > 0:
+            # one polylines call per visible class instead of one rectangle call per box
+            class_ids = self.list_objects.class_ids[:count]
+            visible = self.class_visible[class_ids]
+            rects = self.list_objects.rects[:count][visible]
+            class_ids = class_ids[visible]
+            for class_id in np.unique(class_ids):
+                corners = rects[class_ids == class_id][:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+                image_to_show = cv2.polylines(image_to_show, list(corners), True,
+                                              tuple(self.class_colors[class_id]), 1)
 
         if self.mouse_drag["set"]:
             if self.mouse_drag_type == "from_center" and self.mouse_drag["active"] == "whole_rect":
@@ -285,10 +482,11 @@ class DetectionManager(object):
     def run(self):
         cv2.namedWindow("img", cv2.WINDOW_GUI_NORMAL)
         cv2.setMouseCallback("img", self.mouse_callback)
+        cv2.imshow('img', self.image_for_drawings)
 
         cv2.imshow('Controls', np.zeros((10, 400)).astype(np.uint8))
 
-        self.reader.create_gui_options("Controls")
+        self.reader.create_gui_options("Controls", lambda what, value: self.reader_callback(what, value))
 
         cv2.createTrackbar("alpha", "Controls", 100, 1000, lambda x: self.track_callback('alpha', x))
         cv2.createTrackbar("beta", "Controls", 0, 255, lambda x: self.track_callback('beta', x))
@@ -301,11 +499,16 @@ class DetectionManager(object):
         cv2.createTrackbar("current color B", "Controls", self.color_current[0], 255,
                            lambda x: self.track_callback('color_current_b', x))
 
-        cv2.createTrackbar("others color R", "Controls", self.color_others[2], 255,
+        if len(self.classes) > 1:
+            cv2.createTrackbar("class", "Controls", self.current_class, len(self.classes) - 1,
+                               lambda x: self.track_callback('class', x))
+
+        class_color = self.class_colors[self.current_class]
+        cv2.createTrackbar("class color R", "Controls", class_color[2], 255,
                            lambda x: self.track_callback('color_other_r', x))
-        cv2.createTrackbar("others color G", "Controls", self.color_others[1], 255,
+        cv2.createTrackbar("class color G", "Controls", class_color[1], 255,
                            lambda x: self.track_callback('color_other_g', x))
-        cv2.createTrackbar("others color B", "Controls", self.color_others[0], 255,
+        cv2.createTrackbar("class color B", "Controls", class_color[0], 255,
                            lambda x: self.track_callback('color_other_b', x))
         # cv2.namedWindow('Interface')
         cv2.createButton("save", self.button_callback, "save", cv2.QT_PUSH_BUTTON)
@@ -319,20 +522,26 @@ class DetectionManager(object):
         cv2.createButton("Center", self.button_callback, "start_center", cv2.QT_RADIOBOX, True)
 
         cv2.createButton("Display other objects", self.button_callback, "display_other", cv2.QT_CHECKBOX | cv2.QT_NEW_BUTTONBAR, True)
+        for class_id, name in enumerate(self.classes.names):
+            cv2.createButton(f"Show {name}", self.button_callback, f"show_class_{class_id}", cv2.QT_CHECKBOX, True)
+
+        if len(self.attributes) > 0:
+            cv2.createButton("Attributes :", self.button_callback, "", cv2.QT_PUSH_BUTTON | cv2.QT_NEW_BUTTONBAR)
+            for attribute_id, name in enumerate(self.attributes.names):
+                cv2.createButton(name, self.button_callback, f"attribute_{attribute_id}", cv2.QT_CHECKBOX, False)
 
         cv2.createButton("quit", self.button_callback, "quit", cv2.QT_PUSH_BUTTON | cv2.QT_NEW_BUTTONBAR)
 
         self.prepare_frame()
+        self.refresh_status()
         while self.running:
             self.display_frame()
 
-            key = cv2.waitKey()
-
-            if key == 32:  # SPACE
-                self.next('object')
-            elif key == 115:  # S
-                self.save()
-            elif key == 122:  # Z
-                self.undo()
+            # while a frame is loading, the loop wakes up regularly to show it as soon as it is decoded
+            key = cv2.waitKey(100 if self.frame_pending else 0)
+            if key != -1:
+                self.key_callback(key)
+            if self.frame_pending:
+                self.prepare_frame()
 
         cv2.destroyAllWindows()
@@ -1,24 +1,64 @@
 import numpy as np
 import cv2
+import os
 import json
+import bisect
 from datetime import datetime
 
 from services.file_service import open_file
+from services.frame_cache import FrameCache
+from services.display_service import DisplayBuffers
+from services.export_service import write_json_list
 
 
 class TrackingManager(object):
-    def __init__(self, file, starting_frame=0):
+    def __init__(self, file, starting_frame=0, multi_track=False, store=None, frame_cache=None, recorder=None,
+                 claim_size=50):
         self.list_cells = []
         self.current_cell_position = {}
 
-        self.reader = open_file(self, file)
+        # multi track mode : every active cell is updated on each frame, the selected one is current_cell_position
+        self.multi_track = multi_track
+        self.active_cells = []
+        self.track_history = []
+        # sorted annotated frames of the active cells, by id(cell), so last_position is a bisect instead of a scan
+        self.cell_frames = {}
+
+        # optional shared ProjectStore, cells are committed under local ids allocated by the store, by id(cell)
+        # the tracks being edited are claimed, multi track passes also claim their frames by chunks of claim_size
+        self.store = store
+        self.store_ids = {}
+        self.store_tracks = {}
+        self.track_claims = set()
+        self.store_boxes = []
+        self.claim_size = claim_size
+        self.claimed_range = None
+
+        # (cell, frame, reason) of suspicious positions found by analyze_tracks
+        self.flags = []
+        self.flag_idx = -1
+        # single track : positions replaced since the last jump to a flag, by frame, undo stops at the jump
+        self.jump_edits = None
+
+        self.reader = open_file(self, file, background=True)
+        self.frame_cache = frame_cache if frame_cache is not None else FrameCache()
+
+        # optional SessionRecorder, every GUI event is recorded so the session can be replayed
+        self.recorder = recorder
+        if self.recorder is not None:
+            self.recorder.record_header(type(self).__name__, file=file, starting_frame=starting_frame,
+                                        multi_track=multi_track, claim_size=claim_size)
 
         self.starting_frame = starting_frame
         self.current_frame = self.starting_frame
+        self.claim_current_frame()
         self.current_image = np.zeros((1,1))
         self.image_for_drawings = np.zeros((1,1))
+        self.display_buffers = DisplayBuffers()
+        self.frame_pending = False
 
         self.autosave_interval = 10
+        self.save_folder = "."
 
         self.display_current_points = True
         self.display_other_points = True
@@ -40,63 +80,130 @@ class TrackingManager(object):
         self.display_frame_offset = 0
 
         self.frame_reference = None
-        self.prepare_frame()
-        self.h, self.w = self.current_image.shape[:2]
+        self.h, self.w = 0, 0
 
     def save(self, suffix=None, include_current=False):
-        file_name = f"./save_{str(datetime.now())[:19].replace(':', '-').replace(' ', '_')}.json"
+        file_name = os.path.join(self.save_folder, f"save_{str(datetime.now())[:19].replace(':', '-').replace(' ', '_')}.json")
         if suffix is not None:
             file_name = file_name[:-4] + f"_{suffix}.json"
         else:
             print(f"saving as : {file_name}")
 
-        list_to_save = []
-        for cell_idx in range(len(self.list_cells)):
-            cell = self.list_cells[cell_idx]
-            dict_for_cell = {
-                "id": cell_idx,
-                "timestamps": {}
-            }
-
-            for k, v in cell.items():
-                dict_for_cell["timestamps"][k] = {
-                    "rect": {
-                        'start': (int(v['rect']['start'][0]), int(v['rect']['start'][1])),
-                        'end': (int(v['rect']['end'][0]), int(v['rect']['end'][1])),
-                    }
-                }
-                if v.get("ref"):
-                    dict_for_cell["timestamps"][k]["ref"] = v["ref"]
-
-            list_to_save.append(dict_for_cell)
-
+        cells_to_save = self.list_cells
         if include_current:
-            dict_for_cell = {
-                "id": len(list_to_save),
-                "timestamps": {}
-            }
+            cells_to_save = cells_to_save + (self.active_cells if self.multi_track else [self.current_cell_position])
 
-            for k, v in self.current_cell_position.items():
-                dict_for_cell["timestamps"][k] = {
-                    "rect": {
-                        'start': (int(v['rect']['start'][0]), int(v['rect']['start'][1])),
-                        'end': (int(v['rect']['end'][0]), int(v['rect']['end'][1])),
-                    }
+        # cells are converted and written one by one instead of building the whole list first
+        with open(file_name, 'w') as json_file:
+            output = self.recorder.saving(json_file) if self.recorder is not None else json_file
+            write_json_list(output, (self.cell_to_dict(cell_idx, cell) for cell_idx, cell in enumerate(cells_to_save)))
+        if self.recorder is not None:
+            self.recorder.record_save(output)
+
+    def cell_to_dict(self, cell_idx, cell):
+        dict_for_cell = {
+            "id": cell_idx,
+            "timestamps": {}
+        }
+
+        for k, v in cell.items():
+            dict_for_cell["timestamps"][k] = {
+                "rect": {
+                    'start': (int(v['rect']['start'][0]), int(v['rect']['start'][1])),
+                    'end': (int(v['rect']['end'][0]), int(v['rect']['end'][1])),
                 }
-                if v.get("ref"):
-                    dict_for_cell["timestamps"][k]["ref"] = v["ref"]
+            }
+            if v.get("ref"):
+                dict_for_cell["timestamps"][k]["ref"] = v["ref"]
 
-            list_to_save.append(dict_for_cell)
+        return dict_for_cell
 
-        with open(file_name, 'w') as json_file:
-            json.dump(list_to_save, json_file, indent=4)
+    def commit_to_store(self, cells, frames=None, done=False):
+        if self.store is None:
+            return
+        cells = [cell for cell in cells if frames is not None or len(cell) > 0]
+        new_cells = [cell for cell in cells if id(cell) not in self.store_ids]
+        if len(new_cells) > 0:
+            # allocated by the store, so sessions sharing an annotator name never reuse a local id
+            for cell, local_id in zip(new_cells, self.store.new_local_ids(len(new_cells))):
+                self.store_ids[id(cell)] = local_id
+        if len(cells) > 0 or done:
+            to_commit = [(self.store_ids[id(cell)], cell) for cell in cells]
+            if frames is None:
+                track_ids = self.store.bulk_commit_tracks(to_commit)
+            else:
+                track_ids = self.store.commit_tracks(to_commit, frames, done=done)
+            for cell, track_id in zip(cells, track_ids):
+                self.store_tracks[id(cell)] = track_id
+        self.update_track_claims()
+
+    def update_track_claims(self):
+        # the tracks being edited stay claimed, the finished ones are released
+        if self.store is None:
+            return
+        editing = self.active_cells if self.multi_track else [self.current_cell_position]
+        editing_ids = set(self.store_tracks[id(cell)] for cell in editing if id(cell) in self.store_tracks)
+        for track_id in editing_ids - self.track_claims:
+            if not self.store.claim_track(track_id):
+                print(f"Track {track_id} is being edited by another annotator")
+        for track_id in self.track_claims - editing_ids:
+            self.store.release_track(track_id)
+        self.track_claims = editing_ids
+
+    def claimed_by_others(self, start, end):
+        # annotator editing a track whose box on the displayed frame overlaps (IoU > 0.5) the rect, None otherwise
+        if self.store is None or len(self.store_boxes) == 0:
+            return None
+        claimed = self.store.claimed_tracks()
+        area = (end[0] - start[0]) * (end[1] - start[1])
+        for box in self.store_boxes:
+            if box[3] not in claimed:
+                continue
+            x0, y0, x1, y1 = box[5:9]
+            inter = max(0, min(end[0], x1) - max(start[0], x0)) * max(0, min(end[1], y1) - max(start[1], y0))
+            if inter > 0.5 * (area + (x1 - x0) * (y1 - y0) - inter):
+                return claimed[box[3]]
+        return None
+
+    def claim_current_frame(self):
+        # only multi track passes go through the frames once, single track annotators follow objects
+        if self.store is None or not self.multi_track:
+            return
+        if self.claimed_range is not None and self.claimed_range[0] <= self.current_frame <= self.claimed_range[1]:
+            return
+        self.claimed_range = self.store.claim_frames(self.current_frame, self.claim_size)
+        if self.claimed_range[0] != self.current_frame:
+            print(f"Frames {self.current_frame} to {self.claimed_range[0] - 1} are claimed by other annotators, skipping")
+        self.current_frame = self.claimed_range[0]
+
+    def claim_next_frame(self):
+        # the pass cannot skip frames while tracks are active, it stops at frames claimed by another annotator
+        if self.store is None or self.current_frame + 1 <= self.claimed_range[1]:
+            return True
+        claimed_range = self.store.claim_frames(self.current_frame + 1, self.claim_size)
+        if claimed_range[0] != self.current_frame + 1:
+            self.store.release_frames(claimed_range[0])
+            return False
+        self.claimed_range = claimed_range
+        return True
+
+    def release_claims(self):
+        if self.store is not None:
+            if self.multi_track:
+                self.store.release_frames(self.current_frame)
+            self.store.release_tracks()
+
+    def commit_all_to_store(self):
+        current_cells = self.active_cells if self.multi_track else [self.current_cell_position]
+        self.commit_to_store(self.list_cells + current_cells)
 
     def load(self, file_name):
         with open(file_name, 'r') as json_file:
             data = json.load(json_file)
             for el in data:
-                cell = {int(k): v for k, v in el.items()}
+                cell = {int(k): v for k, v in el["timestamps"].items()}
                 self.list_cells.append(cell)
+        self.commit_all_to_store()
 
     def reset_rect(self):
         self.mouse_drag = {
@@ -111,20 +218,141 @@ class TrackingManager(object):
                0 <= self.mouse_drag["start"][1] < self.mouse_drag["end"][1]
 
     def undo(self):
-        if self.current_cell_position.get(self.current_frame - 1) is not None:
+        if self.multi_track:
+            return self.undo_multi_track()
+        if self.jump_edits is not None:
+            frame = self.current_frame - 1
+            if frame not in self.jump_edits:
+                cv2.displayOverlay("img", "The positions from before the jump are kept", 2000)
+                return
+            replaced = self.jump_edits.pop(frame)
+            if replaced is None:
+                del self.current_cell_position[frame]
+            else:
+                self.current_cell_position[frame] = replaced
+            self.current_frame = frame
+            self.commit_to_store([self.current_cell_position], frames=[frame])
+        elif self.current_cell_position.get(self.current_frame - 1) is not None:
             del self.current_cell_position[self.current_frame - 1]
             self.current_frame -= 1
+            self.commit_to_store([self.current_cell_position], frames=[self.current_frame])
         elif len(self.list_cells) > 0:
             self.current_cell_position = self.list_cells[-1]
             self.list_cells = self.list_cells[:-1]
             self.current_frame = max(k for k, _ in self.current_cell_position.items()) + 1
+            self.update_track_claims()
         self.reset_display_offset()
         self.reset_rect()
         self.prepare_frame()
         self.display_frame()
         self.refresh_track_frame()
 
+    def undo_multi_track(self):
+        if len(self.track_history) > 0:
+            action = self.track_history.pop()
+            if action[0] == "position":
+                _, cell, frame, replaced, created = action
+                if replaced is None:
+                    self.frames_of(cell).remove(frame)
+                    del cell[frame]
+                else:
+                    cell[frame] = replaced
+                if created:
+                    self.active_cells = [c for c in self.active_cells if c is not cell]
+                    del self.cell_frames[id(cell)]
+                    self.current_cell_position = {}
+                else:
+                    self.current_cell_position = cell
+                self.commit_to_store([cell], frames=[frame])
+            elif action[0] == "frame":
+                self.current_frame -= 1
+                self.select_pending_track()
+            elif action[0] == "terminate":
+                _, cell, active_idx = action
+                self.list_cells = [c for c in self.list_cells if c is not cell]
+                self.active_cells.insert(active_idx, cell)
+                self.current_cell_position = cell
+                self.update_track_claims()
+        self.reset_display_offset()
+        self.reset_rect()
+        self.prepare_frame()
+        self.display_frame()
+        self.refresh_track_frame()
+
+    def is_active(self, cell):
+        return any(c is cell for c in self.active_cells)
+
+    def frames_of(self, cell):
+        frames = self.cell_frames.get(id(cell))
+        if frames is None:
+            frames = self.cell_frames[id(cell)] = sorted(cell)
+        return frames
+
+    def last_position(self, cell, frame_idx):
+        frames = self.frames_of(cell)
+        idx = bisect.bisect_right(frames, frame_idx)
+        if idx == 0:
+            return None
+        return cell[frames[idx - 1]]
+
+    def select_pending_track(self):
+        # first active cell without a position on the current frame, otherwise a new track
+        for cell in self.active_cells:
+            if cell.get(self.current_frame) is None:
+                self.current_cell_position = cell
+                return
+        self.current_cell_position = {}
+
+    def select_track(self, x, y):
+        selected = {}
+        selected_area = None
+        for cell in self.active_cells:
+            position = self.last_position(cell, self.current_frame)
+            if position is None:
+                continue
+            start, end = position['rect']['start'], position['rect']['end']
+            if start[0] <= x <= end[0] and start[1] <= y <= end[1]:
+                area = (end[0] - start[0]) * (end[1] - start[1])
+                if selected_area is None or area < selected_area:
+                    selected, selected_area = cell, area
+        self.current_cell_position = selected
+
+    def new_track(self):
+        self.current_cell_position = {}
+        self.reset_rect()
+        self.display_frame()
+
+    def terminate_track(self):
+        if not self.is_active(self.current_cell_position):
+            return
+        cell = self.current_cell_position
+        active_idx = [i for i, c in enumerate(self.active_cells) if c is cell][0]
+        del self.active_cells[active_idx]
+        self.list_cells.append(cell)
+        self.track_history.append(("terminate", cell, active_idx))
+        self.commit_to_store([cell])
+
+        self.reset_rect()
+        self.select_pending_track()
+        self.display_frame()
+
+        if len(self.list_cells) % self.autosave_interval == 0:
+            self.save("autosave", include_current=True)
+
     def next(self, what):
+        if self.frame_pending:
+            # the displayed frame is not the current one yet
+            return
+        if what in ("time", "frame") and self.display_frame_offset != 0:
+            # the rect was drawn on another frame than the one it would be stored under
+            self.reset_display_offset()
+            self.refresh_track_frame()
+            self.prepare_frame()
+            self.display_frame()
+            cv2.displayOverlay("img", f"Back to frame {self.current_frame}, validate again", 2000)
+            return
+        if self.multi_track:
+            return self.next_multi_track(what)
         if what == "time":
             # validate rect
             if self.mouse_drag["end"][0] >= 0 and self.mouse_drag["end"][1] >= 0:
@@ -135,7 +363,15 @@ class TrackingManager(object):
                         "end": self.mouse_drag["end"]
                     }
                 }
+                if len(self.current_cell_position) == 0:
+                    owner = self.claimed_by_others(self.mouse_drag["start"], self.mouse_drag["end"])
+                    if owner is not None:
+                        cv2.displayOverlay("img", f"This object is being tracked by {owner}", 2000)
+                        return
+                if self.jump_edits is not None and self.current_frame not in self.jump_edits:
+                    self.jump_edits[self.current_frame] = self.current_cell_position.get(self.current_frame)
                 self.current_cell_position[self.current_frame] = dict_to_add
+                self.commit_to_store([self.current_cell_position], frames=[self.current_frame])
 
                 self.prepare_frame()
                 self.current_frame += 1
@@ -146,8 +382,11 @@ class TrackingManager(object):
                 return self.next("cell")
         elif what == "cell":
             self.list_cells.append(self.current_cell_position)
+            self.commit_to_store([self.current_cell_position])
             self.current_cell_position = {}
             self.current_frame = self.starting_frame
+            self.jump_edits = None
+            self.update_track_claims()
 
             self.reset_display_offset()
             self.reset_rect()
@@ -159,6 +398,101 @@ class TrackingManager(object):
             if len(self.list_cells) % self.autosave_interval == 0:
                 self.save("autosave")
 
+    def analyze_tracks(self):
+        from services.track_analytics import tracks_to_arrays, compute_metrics, flagged_frames
+
+        # the tracks being edited are checked too
+        current_cells = self.active_cells if self.multi_track else [self.current_cell_position]
+        cells = [cell for cell in self.list_cells + current_cells if len(cell) > 0]
+        metrics = compute_metrics(tracks_to_arrays(cells))
+        self.flags = [(cells[t], f, reason) for t, f, reason in flagged_frames(metrics)]
+        self.flag_idx = -1
+        print(f"{len(self.flags)} suspicious positions in {len(cells)} cells")
+
+    def jump_to_flag(self):
+        if len(self.flags) == 0:
+            return
+        self.flag_idx = (self.flag_idx + 1) % len(self.flags)
+        cell, frame, reason = self.flags[self.flag_idx]
+        message = f"{reason} ({self.flag_idx + 1}/{len(self.flags)})"
+
+        if self.multi_track:
+            # finished cells are not reopened and the pass does not move, the flagged frame is only displayed
+            self.display_frame_offset = frame - self.current_frame
+            self.prepare_frame()
+            self.display_frame()
+            cv2.displayOverlay("img", f"{message} - displaying frame {frame}, the pass stays at {self.current_frame}", 0)
+            return
+
+        # the flagged cell becomes the one being edited
+        if cell is not self.current_cell_position:
+            if len(self.current_cell_position) > 0:
+                self.list_cells.append(self.current_cell_position)
+                self.commit_to_store([self.current_cell_position])
+            self.list_cells = [c for c in self.list_cells if c is not cell]
+        self.current_cell_position = cell
+        self.current_frame = frame
+        self.jump_edits = {}
+        self.update_track_claims()
+
+        self.reset_display_offset()
+        self.reset_rect()
+        self.prepare_frame()
+        self.display_frame()
+        self.refresh_track_frame()
+        cv2.displayOverlay("img", message, 2000)
+
+    def next_multi_track(self, what):
+        if what == "time":
+            if self.mouse_drag["end"][0] >= 0 and self.mouse_drag["end"][1] >= 0:
+                created = not self.is_active(self.current_cell_position)
+                if created:
+                    owner = self.claimed_by_others(self.mouse_drag["start"], self.mouse_drag["end"])
+                    if owner is not None:
+                        cv2.displayOverlay("img", f"This object is being tracked by {owner}", 2000)
+                        return
+                    self.active_cells.append(self.current_cell_position)
+                cell = self.current_cell_position
+                self.track_history.append(("position", cell, self.current_frame, cell.get(self.current_frame), created))
+                if cell.get(self.current_frame) is None:
+                    bisect.insort(self.frames_of(cell), self.current_frame)
+                cell[self.current_frame] = {
+                    "ref": self.frame_reference,
+                    "rect": {
+                        "start": self.mouse_drag["start"],
+                        "end": self.mouse_drag["end"]
+                    }
+                }
+
+                self.reset_rect()
+                self.select_pending_track()
+                self.display_frame()
+            else:
+                return self.next_multi_track("frame")
+        elif what == "frame":
+            if self.current_frame + 1 >= self.reader.get_frame_count():
+                print("Last frame reached, end the remaining tracks and save")
+                return
+            if not self.claim_next_frame():
+                print(f"Frame {self.current_frame + 1} is claimed by another annotator, end the remaining tracks and save")
+                return
+            self.commit_to_store(self.active_cells, frames=[self.current_frame], done=True)
+            self.current_frame += 1
+            self.track_history.append(("frame",))
+
+            self.reset_display_offset()
+            self.reset_rect()
+            self.select_pending_track()
+
+            self.prepare_frame()
+            self.display_frame()
+            self.refresh_track_frame()
+
+            if self.current_frame % self.autosave_interval == 0:
+                self.save("autosave", include_current=True)
+        elif what == "cell":
+            self.terminate_track()
+
     def set_autosave_interval(self, interval):
         self.autosave_interval = interval
 
@@ -174,9 +508,18 @@ class TrackingManager(object):
         elif idx == 3:
             self.mouse_drag["end"] = np.array([x, y])
 
+    def record_event(self, kind, *args):
+        if self.recorder is not None:
+            self.recorder.record(kind, *args)
+
+    def reader_callback(self, what, value):
+        self.record_event("reader", what, value)
+        self.reader.signal_from_gui(what, value=value)
+
     def mouse_callback(self, event, x, y, flags, userdata, **kargs):
         if bool(kargs):
             print(f"mouseCallback - Extra arguments {kargs}")
+        self.record_event("mouse", event, x, y, flags)
 
         if event == cv2.EVENT_MOUSEMOVE:
             if flags & cv2.EVENT_FLAG_RBUTTON:
@@ -225,6 +568,9 @@ class TrackingManager(object):
                 self.reset_rect()
                 self.mouse_drag["start"] = np.array([x, y])
                 self.mouse_drag["active"] = "whole_rect"
+
+        elif event == cv2.EVENT_LBUTTONDOWN and self.multi_track:
+            self.select_track(x, y)
         else:
             return
         self.display_frame()
@@ -232,6 +578,7 @@ class TrackingManager(object):
     def track_callback(self, what, value, **kargs):
         if bool(kargs):
             print(f"trackCallback - Extra arguments {kargs}")
+        self.record_event("track", what, value)
         if what == 'frame':
             value -= self.current_frame
             if value == 0:
@@ -290,20 +637,34 @@ class TrackingManager(object):
     def button_callback(self, state, data, **kargs):
         if bool(kargs):
             print(f"button_callback - Extra arguments {kargs}")
+        self.record_event("button", state, data)
         if data == "save":
-            self.save()
+            # in multi track mode most tracks stay active until the end of the pass
+            self.save(include_current=self.multi_track)
         elif data == 'save_include':
             self.save(include_current=True)
         elif data == "undo":
             self.undo()
         elif data == "quit":
-            self.save("onquit")
+            self.save("onquit", include_current=self.multi_track)
+            if self.recorder is not None:
+                self.recorder.close()
+            print(f"frame cache : {self.frame_cache.stats()}")
+            self.release_claims()
             self.running = False
             exit(0)
         elif data == 'time':
             self.next('time')
         elif data == 'cell':
             self.next('cell')
+        elif data == 'frame':
+            self.next('frame')
+        elif data == 'new_track':
+            self.new_track()
+        elif data == 'analyze':
+            self.analyze_tracks()
+        elif data == 'next_flag':
+            self.jump_to_flag()
         elif data == "start_center" and state == 1:
             self.mouse_drag_type = "from_center"
             self.display_frame()
@@ -322,28 +683,70 @@ class TrackingManager(object):
             self.display_current_points = state == 1
             self.display_frame()
 
+    def key_callback(self, key):
+        self.record_event("key", key)
+        if key == 32:  # SPACE
+            self.next('time')
+        elif key == 115:  # S
+            self.save(include_current=self.multi_track)
+        elif key == 122:  # Z
+            self.undo()
+        elif key == 102 and self.multi_track:  # F
+            self.next('frame')
+        elif key == 110 and self.multi_track:  # N
+            self.new_track()
+        elif key == 116 and self.multi_track:  # T
+            self.next('cell')
+        elif key == 97:  # A
+            self.analyze_tracks()
+        elif key == 106:  # J
+            self.jump_to_flag()
+
     def force_refresh(self):
+        # reader settings changed, cached frames are outdated
+        self.frame_cache.clear()
         self.prepare_frame()
         self.display_frame()
 
+    def frame_ready(self, frame_idx):
+        # the reader decodes in the background, never wait in a callback : the progress is shown and run() prepares
+        # the frame again once it is available
+        if self.reader.error is not None:
+            raise self.reader.error
+        if self.reader.is_frame_ready(frame_idx):
+            if self.frame_pending:
+                cv2.displayOverlay("img", "", 1)
+                self.frame_pending = False
+            return True
+        cv2.displayOverlay("img", f"Loading ... {100 * self.reader.progress:.0f} %", 0)
+        self.frame_pending = True
+        return False
+
+    def read_frame(self, frame_idx):
+        cached = self.frame_cache.get(frame_idx)
+        if cached is None:
+            cached = self.reader.get_frame(frame_idx)
+            self.frame_cache.put(frame_idx, *cached)
+        return cached
+
     def prepare_frame(self):
         frame_idx = self.current_frame + self.display_frame_offset
-        image, self.frame_reference = self.reader.get_frame(frame_idx)
-
-        self.current_image = image.copy()
-        if len(image.shape) == 2:
-            self.current_image = cv2.cvtColor(self.current_image, cv2.COLOR_GRAY2BGR)
-
-        self.image_for_drawings = np.clip(
-            ((((self.current_image.astype(np.float64) / 255.) ** self.gamma) * 255.) * self.alpha + self.beta),
-            0,
-            255
-        ).astype(np.uint8)
+        if not self.frame_ready(frame_idx):
+            return
+        image, self.frame_reference = self.read_frame(frame_idx)
+        if self.store is not None:
+            # boxes of the other annotators, fetched once per frame
+            self.store_boxes = self.store.boxes_in_frame(frame_idx, exclude_annotator=self.store.annotator)
+
+        # no copy, grey frames stay single channel until display_frame expands them for the overlays
+        self.current_image = image
+        self.image_for_drawings = self.display_buffers.adjust(image, self.alpha, self.beta, self.gamma)
+        self.h, self.w = self.current_image.shape[:2]
 
     def display_frame(self):
         frame_idx = self.current_frame + self.display_frame_offset
 
-        image_to_show = self.image_for_drawings.copy()
+        image_to_show = self.display_buffers.to_display()
 
         if self.display_other_points:
             for cell in self.list_cells:
@@ -353,6 +756,24 @@ class TrackingManager(object):
                     image_to_show = cv2.rectangle(image_to_show, tuple(rect["start"]),
                                                   tuple(rect["end"]), tuple(self.color_others), 1)
 
+            for box in self.store_boxes:
+                image_to_show = cv2.rectangle(image_to_show, tuple(box[5:7]), tuple(box[7:9]),
+                                              tuple(self.color_others), 1)
+
+        if self.multi_track:
+            for cell in self.active_cells:
+                thickness = 2 if cell is self.current_cell_position else 1
+                if cell.get(frame_idx) is not None:
+                    rect = cell[frame_idx]['rect']
+                    image_to_show = cv2.rectangle(image_to_show, tuple(rect["start"]),
+                                                  tuple(rect["end"]), tuple(self.color_current), thickness)
+                else:
+                    last_dict = self.last_position(cell, frame_idx - 1)
+                    if last_dict is not None:
+                        rect = last_dict['rect']
+                        image_to_show = cv2.rectangle(image_to_show, tuple(rect["start"]),
+                                                      tuple(rect["end"]), tuple(self.color_past), thickness)
+
         if self.display_current_points:
             for i in range(0, 4):
                 if self.current_cell_position.get(frame_idx - i - 1) is not None:
@@ -376,9 +797,10 @@ class TrackingManager(object):
     def run(self):
         cv2.namedWindow("img", cv2.WINDOW_GUI_NORMAL)
         cv2.setMouseCallback("img", self.mouse_callback)
+        cv2.imshow('img', self.image_for_drawings)
         cv2.imshow('Controls', np.zeros((10, 400)).astype(np.uint8))
 
-        self.reader.create_gui_options("Controls")
+        self.reader.create_gui_options("Controls", lambda what, value: self.reader_callback(what, value))
 
         cv2.createTrackbar("frame offset", "Controls", 0, self.reader.get_frame_count(), lambda x: self.track_callback('frame', x))
         cv2.createTrackbar("alpha", "Controls", 100, 1000, lambda x: self.track_callback('alpha', x))
@@ -410,10 +832,18 @@ class TrackingManager(object):
         cv2.createButton("save (include current)", self.button_callback, "save_include", cv2.QT_PUSH_BUTTON)
         cv2.createButton("undo", self.button_callback, "undo", cv2.QT_PUSH_BUTTON | cv2.QT_NEW_BUTTONBAR)
         cv2.createButton("next time", self.button_callback, "time", cv2.QT_PUSH_BUTTON)
-        cv2.createButton("next cell", self.button_callback, "cell", cv2.QT_PUSH_BUTTON)
+        if self.multi_track:
+            cv2.createButton("next frame", self.button_callback, "frame", cv2.QT_PUSH_BUTTON)
+            cv2.createButton("new track", self.button_callback, "new_track", cv2.QT_PUSH_BUTTON)
+            cv2.createButton("end track", self.button_callback, "cell", cv2.QT_PUSH_BUTTON)
+        else:
+            cv2.createButton("next cell", self.button_callback, "cell", cv2.QT_PUSH_BUTTON)
 
         cv2.createButton("reset frame display offset", self.button_callback, "reset_frame_offset", cv2.QT_PUSH_BUTTON | cv2.QT_NEW_BUTTONBAR)
 
+        cv2.createButton("analyze tracks", self.button_callback, "analyze", cv2.QT_PUSH_BUTTON | cv2.QT_NEW_BUTTONBAR)
+        cv2.createButton("next suspicious frame", self.button_callback, "next_flag", cv2.QT_PUSH_BUTTON)
+
         cv2.createButton("Start drawing rectangle from :", self.button_callback, "", cv2.QT_PUSH_BUTTON | cv2.QT_NEW_BUTTONBAR)
         cv2.createButton("Top left corner", self.button_callback, "start_top_left", cv2.QT_RADIOBOX)
         cv2.createButton("Center", self.button_callback, "start_center", cv2.QT_RADIOBOX, True)
@@ -427,13 +857,11 @@ class TrackingManager(object):
         while self.running:
             self.display_frame()
 
-            key = cv2.waitKey()
-
-            if key == 32:  # SPACE
-                self.next('time')
-            elif key == 115:  # S
-                self.save()
-            elif key == 122:  # Z
-                self.undo()
+            # while a frame is loading, the loop wakes up regularly to show it as soon as it is decoded
+            key = cv2.waitKey(100 if self.frame_pending else 0)
+            if key != -1:
+                self.key_callback(key)
+            if self.frame_pending:
+                self.prepare_frame()
 
         cv2.destroyAllWindows()
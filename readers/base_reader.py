@@ -5,14 +5,36 @@ class BaseReader(object):
 
         self.caller = caller
 
+        # filled by load(), which may run in a background thread
+        self.progress = 0.
+        self.loaded = False
+        self.error = None
+
+    def load(self):
+        self.progress = 1.
+        self.loaded = True
+
+    def safe_load(self):
+        try:
+            self.load()
+        except Exception as e:
+            self.error = e
+
+    def is_frame_ready(self, idx):
+        return self.loaded
+
     def get_frame(self, idx):
         pass
 
     def get_frame_count(self):
         pass
 
+    def frame_index(self, reference):
+        # index of the frame returned with this reference by get_frame, None when unknown
+        return None
+
     def signal_from_gui(self, **kargs):
         pass
 
-    def create_gui_options(self, window_name):
+    def create_gui_options(self, window_name, callback=None):
         pass
@@ -11,6 +11,7 @@ class FolderReader(BaseReader):
         self.path_to_folder = path_to_folder
         self.all_files = os.listdir(path_to_folder)
         self.all_files = [file for file in self.all_files if file[-4:] == '.jpg' or file[-4:] == '.png' or file[-4:] == '.tif']
+        self.frame_indexes = None
 
     def get_frame(self, idx):
         file_name = self.all_files[idx]
@@ -21,8 +22,15 @@ class FolderReader(BaseReader):
     def get_frame_count(self):
         return len(self.all_files)
 
+    def frame_index(self, reference):
+        if self.frame_indexes is None:
+            self.frame_indexes = {}
+            for idx, file_name in enumerate(self.all_files):
+                self.frame_indexes.setdefault(file_name[:file_name.rfind(".")], idx)
+        return self.frame_indexes.get(reference)
+
     def signal_from_gui(self, what, **kargs):
         pass
 
-    def create_gui_options(self, window_name):
+    def create_gui_options(self, window_name, callback=None):
         pass
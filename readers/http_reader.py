@@ -0,0 +1,231 @@
+import re
+import json
+import time
+import struct
+import numpy as np
+import cv2
+from urllib.parse import unquote, urljoin
+
+from readers.base_reader import BaseReader
+from readers.tiff_reader import TiffReader
+from services.http_service import HttpClient
+
+
+# size in bytes of the TIFF field types
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+# (offsets, byte counts) tags of the image data
+TIFF_DATA_TAGS = {273: 279, 324: 325}
+# tags pointing elsewhere in the file, useless to decode a single page
+TIFF_DROPPED_TAGS = {288, 289, 330, 34665, 34853}
+# bytes requested per directory, enough for the usual amount of entries
+TIFF_IFD_WINDOW = 4096
+
+
+class HttpFolderReader(BaseReader):
+    def __init__(self, caller, url, client=None, prefetch=4):
+        super().__init__(caller, url)
+
+        self.url = url if url.endswith("/") else url + "/"
+        self.client = client if client is not None else HttpClient()
+        self.prefetch = prefetch
+        self.all_files = []
+        self.frame_indexes = None
+
+    def load(self):
+        # directory listing as served by http.server and most static file servers
+        listing = self.client.request(self.url)[2].decode(errors="replace")
+        # links are kept quoted, they are only unquoted to name the frames
+        links = re.findall(r'href="([^"?#]+)"', listing)
+        self.all_files = [link for link in links if link[-4:] == '.jpg' or link[-4:] == '.png' or link[-4:] == '.tif']
+        self.progress = 1.
+        self.loaded = True
+
+    def get_frame(self, idx):
+        for next_idx in range(idx + 1, min(idx + 1 + self.prefetch, len(self.all_files))):
+            self.client.prefetch(urljoin(self.url, self.all_files[next_idx]))
+
+        file_name = self.all_files[idx]
+        data = self.client.get(urljoin(self.url, file_name))
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        file_name = unquote(file_name[file_name.rfind("/") + 1:])
+        return img, file_name[:file_name.rfind(".")]
+
+    def get_frame_count(self):
+        return len(self.all_files)
+
+    def frame_index(self, reference):
+        # the listing is downloaded by load(), which runs in the background
+        while not self.loaded and self.error is None:
+            time.sleep(0.05)
+        if self.frame_indexes is None:
+            self.frame_indexes = {}
+            for idx, link in enumerate(self.all_files):
+                file_name = unquote(link[link.rfind("/") + 1:])
+                self.frame_indexes.setdefault(file_name[:file_name.rfind(".")], idx)
+        return self.frame_indexes.get(reference)
+
+    def signal_from_gui(self, what, **kargs):
+        pass
+
+    def create_gui_options(self, window_name, callback=None):
+        pass
+
+
+class HttpTiffReader(TiffReader):
+    def __init__(self, caller, url, client=None, prefetch=4):
+        self.url = url
+        self.client = client if client is not None else HttpClient()
+        self.prefetch = prefetch
+        self.byte_order = "<"
+        # per page : list of (tag, type, count, raw value or offset field)
+        self.pages = []
+
+        super().__init__(caller, url)
+
+    def read(self, offset, length):
+        return self.client.read_range(self.url, offset, length)
+
+    def count_pages(self):
+        # nothing is downloaded before load(), which runs in the background and counts the pages
+        return len(self.pages)
+
+    def walk_pages(self):
+        # walks the IFD chain with one small range request per page, pages are usable as soon as they are found
+        header = self.client.fetch_range(self.url, 0, 8)
+        if header[:2] == b"II":
+            self.byte_order = "<"
+        elif header[:2] == b"MM":
+            self.byte_order = ">"
+        else:
+            raise ValueError(f"{self.url} is not a TIFF file")
+        magic, ifd_offset = struct.unpack(self.byte_order + "HI", header[2:])
+        if magic != 42:
+            raise ValueError(f"{self.url} : only classic TIFF is supported (not BigTIFF)")
+
+        size = self.client.size(self.url)
+        while ifd_offset != 0:
+            data = self.client.fetch_range(self.url, ifd_offset, TIFF_IFD_WINDOW)
+            entry_count = struct.unpack(self.byte_order + "H", data[:2])[0]
+            if len(data) < 2 + 12 * entry_count + 4:
+                data = self.client.fetch_range(self.url, ifd_offset, 2 + 12 * entry_count + 4)
+            entries = [struct.unpack(self.byte_order + "HHI4s", data[2 + 12 * i:2 + 12 * (i + 1)])
+                       for i in range(entry_count)]
+            self.pages.append(entries)
+            self.page_count = len(self.pages)
+            if self.page_count <= self.prefetch:
+                self.prefetch_page(self.page_count - 1)
+            ifd_offset = struct.unpack(self.byte_order + "I", data[2 + 12 * entry_count:2 + 12 * entry_count + 4])[0]
+            # directories usually follow their image data, their offset tells how far the walk is
+            self.progress = min(ifd_offset / max(size, 1), 0.99) if ifd_offset != 0 else 1.
+
+    def load(self):
+        # the directories of an already opened stack are cached on disk, the walk is only done once per version
+        self.client.revalidate(self.url)
+        cached = self.client.read_cache(self.url, "ifds")
+        if cached is not None:
+            index = json.loads(cached)
+            self.byte_order = index["byte_order"]
+            self.pages = [[(tag, field_type, count, bytes.fromhex(raw)) for tag, field_type, count, raw in entries]
+                          for entries in index["pages"]]
+            self.page_count = len(self.pages)
+            for page_idx in range(min(self.prefetch, self.page_count)):
+                self.prefetch_page(page_idx)
+        else:
+            self.walk_pages()
+            index = {"byte_order": self.byte_order,
+                     "pages": [[(tag, field_type, count, raw.hex()) for tag, field_type, count, raw in entries]
+                               for entries in self.pages]}
+            self.client.write_cache(self.url, "ifds", json.dumps(index).encode())
+        self.progress = 1.
+        self.loaded = True
+
+    def is_frame_ready(self, idx):
+        return self.loaded or idx * self.channels_count + self.channel_to_show < len(self.pages)
+
+    def values(self, field_type, count, raw):
+        size = TIFF_TYPE_SIZES.get(field_type, 1) * count
+        if size > 4:
+            raw = self.read(struct.unpack(self.byte_order + "I", raw)[0], size)
+        return raw[:size]
+
+    def data_ranges(self, page_idx):
+        ranges = []
+        entries = {entry[0]: entry for entry in self.pages[page_idx]}
+        for offsets_tag, counts_tag in TIFF_DATA_TAGS.items():
+            if offsets_tag in entries and counts_tag in entries:
+                offsets = self.unpack_numbers(entries[offsets_tag])
+                counts = self.unpack_numbers(entries[counts_tag])
+                ranges.append((offsets_tag, offsets, counts))
+        return ranges
+
+    def unpack_numbers(self, entry):
+        _, field_type, count, raw = entry
+        code = {3: "H", 4: "I", 16: "Q"}[field_type]
+        return list(struct.unpack(f"{self.byte_order}{count}{code}", self.values(field_type, count, raw)))
+
+    def read_page(self, page_idx):
+        # rebuilds a single page TIFF in memory (header, directory, values, image data) and decodes it
+        data_ranges = self.data_ranges(page_idx)
+        data_tags = {offsets_tag: (offsets, counts) for offsets_tag, offsets, counts in data_ranges}
+        counts_tags = set(TIFF_DATA_TAGS[offsets_tag] for offsets_tag in data_tags)
+
+        entries = [e for e in self.pages[page_idx] if e[0] not in TIFF_DROPPED_TAGS]
+        ifd_size = 2 + 12 * len(entries) + 4
+        out_of_line = bytearray()
+        image_data = bytearray()
+        fields = []
+        data_start = 8 + ifd_size
+        # image data is fetched as one range per tag, its chunks come in parallel
+        blocks = {}
+        for offsets_tag, (offsets, counts) in data_tags.items():
+            first = min(offsets)
+            blocks[offsets_tag] = (first, self.read(first, max(o + c for o, c in zip(offsets, counts)) - first))
+
+        for tag, field_type, count, raw in entries:
+            if tag in counts_tags:
+                value = struct.pack(f"{self.byte_order}{count}I", *self.unpack_numbers((tag, field_type, count, raw)))
+                field_type = 4
+            elif tag in data_tags:
+                offsets, counts = data_tags[tag]
+                first, block = blocks[tag]
+                new_offsets = []
+                for offset, byte_count in zip(offsets, counts):
+                    new_offsets.append(len(image_data))
+                    image_data += block[offset - first:offset - first + byte_count]
+                # relocated once the position of the image data is known
+                value = ("data", new_offsets)
+                field_type = 4
+            else:
+                value = self.values(field_type, count, raw)
+            fields.append((tag, field_type, count, value))
+
+        values_size = sum(len(v) + len(v) % 2 for _, _, _, v in fields if not isinstance(v, tuple) and len(v) > 4)
+        values_size += sum(4 * len(v[1]) for _, _, _, v in fields if isinstance(v, tuple) and len(v[1]) > 1)
+        image_start = data_start + values_size
+
+        ifd = bytearray(struct.pack(self.byte_order + "H", len(fields)))
+        for tag, field_type, count, value in fields:
+            if isinstance(value, tuple):
+                value = struct.pack(f"{self.byte_order}{count}I", *[image_start + o for o in value[1]])
+            if len(value) > 4:
+                ifd += struct.pack(self.byte_order + "HHII", tag, field_type, count, data_start + len(out_of_line))
+                out_of_line += value + b"\0" * (len(value) % 2)
+            else:
+                ifd += struct.pack(self.byte_order + "HHI", tag, field_type, count) + value.ljust(4, b"\0")
+        ifd += struct.pack(self.byte_order + "I", 0)
+
+        header = (b"II" if self.byte_order == "<" else b"MM") + struct.pack(self.byte_order + "HI", 42, 8)
+        buffer = np.frombuffer(bytes(header + ifd + out_of_line + image_data), dtype=np.uint8)
+        return cv2.imdecode(buffer, cv2.IMREAD_ANYCOLOR)
+
+    def prefetch_page(self, page_idx):
+        for _, offsets, counts in self.data_ranges(page_idx):
+            first = min(offsets)
+            self.client.prefetch_range(self.url, first, max(o + c for o, c in zip(offsets, counts)) - first)
+
+    def get_frame(self, idx):
+        page_idx = idx * self.channels_count + self.channel_to_show
+        for next_idx in range(1, self.prefetch + 1):
+            if page_idx + next_idx * self.channels_count < self.page_count:
+                self.prefetch_page(page_idx + next_idx * self.channels_count)
+        return self.read_page(page_idx), f'timestamp_{idx}'
@@ -7,7 +7,9 @@ class TiffReader(BaseReader):
     def __init__(self, caller, path_to_file):
         super().__init__(caller, path_to_file)
 
-        _, self.all_frames = cv2.imreadmulti(path_to_file)
+        self.path_to_file = path_to_file
+        # pages are decoded one by one on demand, none is kept here, the caller's frame cache keeps them within its budget
+        self.page_count = self.count_pages()
 
         self.channels_count = 1
         # self.depth_count = 1
@@ -17,12 +19,24 @@ class TiffReader(BaseReader):
 
         self.convert_to_rgb = False
 
+    def count_pages(self):
+        return cv2.imcount(self.path_to_file)
+
+    def read_page(self, page_idx):
+        _, pages = cv2.imreadmulti(self.path_to_file, page_idx, 1)
+        return pages[0]
+
     def get_frame(self, idx):
         timestamps = idx * self.channels_count + self.channel_to_show
-        return self.all_frames[timestamps], f'timestamp_{idx}'
+        return self.read_page(timestamps), f'timestamp_{idx}'
 
     def get_frame_count(self):
-        return len(self.all_frames) // self.channels_count
+        return self.page_count // self.channels_count
+
+    def frame_index(self, reference):
+        if reference.startswith("timestamp_") and reference[len("timestamp_"):].isdigit():
+            return int(reference[len("timestamp_"):])
+        return None
 
     def signal_from_gui(self, what, **kargs):
         if what == 'channels_count':
@@ -32,13 +46,16 @@ class TiffReader(BaseReader):
             self.channel_to_show = min(self.channels_count, int(kargs['value'][0])) - 1
             self.caller.force_refresh()
 
-    def create_gui_options(self, window_name):
+    def create_gui_options(self, window_name, callback=None):
+        # the caller may pass its own callback(what, value), which ends up calling signal_from_gui
+        if callback is None:
+            callback = lambda what, value: self.signal_from_gui(what=what, value=value)
         cv2.createTrackbar("Amount of channels", window_name, 1, 4,
-                           lambda *x: self.signal_from_gui(what='channels_count', value=x))
+                           lambda *x: callback('channels_count', x))
         cv2.setTrackbarMin("Amount of channels", window_name, 1)
         cv2.setTrackbarMax("Amount of channels", window_name, 4)
 
         cv2.createTrackbar("Channel to show", window_name, 1, 4,
-                           lambda *x: self.signal_from_gui(what='channel_show', value=x))
+                           lambda *x: callback('channel_show', x))
         cv2.setTrackbarMin("Channel to show", window_name, 1)
         cv2.setTrackbarMax("Channel to show", window_name, 4)
@@ -0,0 +1,49 @@
+import numpy as np
+import cv2
+
+
+def reuse(buffer, shape):
+    if buffer is None or buffer.shape != shape:
+        return np.empty(shape, dtype=np.uint8)
+    return buffer
+
+
+class DisplayBuffers(object):
+    def __init__(self):
+        # adjusted frame, same channels as the source frame, and its BGR version overlays are drawn on
+        self.adjusted = np.zeros((1, 1), dtype=np.uint8)
+        self.display = None
+
+        self.lut = None
+        self.lut_params = None
+
+    def adjust(self, image, alpha, beta, gamma):
+        if image.dtype != np.uint8:
+            self.adjusted = np.clip(
+                ((((image.astype(np.float64) / 255.) ** gamma) * 255.) * alpha + beta),
+                0,
+                255
+            ).astype(np.uint8)
+            return self.adjusted
+
+        # 8 bits frames : the same formula evaluated once per grey level, then one table lookup per pixel
+        if self.lut_params != (alpha, beta, gamma):
+            self.lut = np.clip(
+                ((((np.arange(256, dtype=np.float64) / 255.) ** gamma) * 255.) * alpha + beta),
+                0,
+                255
+            ).astype(np.uint8)
+            self.lut_params = (alpha, beta, gamma)
+        self.adjusted = reuse(self.adjusted, image.shape)
+        cv2.LUT(image, self.lut, dst=self.adjusted)
+        return self.adjusted
+
+    def to_display(self):
+        self.display = reuse(self.display, self.adjusted.shape[:2] + (3,))
+        if self.adjusted.ndim == 2 or self.adjusted.shape[2] == 1:
+            cv2.cvtColor(self.adjusted, cv2.COLOR_GRAY2BGR, dst=self.display)
+        elif self.adjusted.shape[2] == 4:
+            cv2.cvtColor(self.adjusted, cv2.COLOR_BGRA2BGR, dst=self.display)
+        else:
+            np.copyto(self.display, self.adjusted)
+        return self.display
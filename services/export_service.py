@@ -0,0 +1,125 @@
+import os
+import gzip
+import json
+import sqlite3
+import argparse
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor
+
+from services.project_store import database_path
+
+
+EXPORT_FORMATS = {"mot": ".txt", "jsonl": ".jsonl"}
+
+TRACK_ROWS_QUERY = "SELECT frame, track_id, ref, x0, y0, x1, y1 FROM boxes " \
+                   "WHERE track_id IS NOT NULL AND frame BETWEEN ? AND ? ORDER BY frame, track_id"
+
+
+def write_json_list(json_file, items, indent=4):
+    # same output as json.dump(list(items), json_file, indent=indent), one item in memory at a time
+    prefix = " " * indent
+    first = True
+    for item in items:
+        json_file.write("[\n" if first else ",\n")
+        json_file.write("\n".join(prefix + line for line in json.dumps(item, indent=indent).split("\n")))
+        first = False
+    json_file.write("[]" if first else "\n]")
+
+
+def open_output(file_name, compress=False):
+    if compress:
+        return gzip.open(file_name, 'wt', compresslevel=6, newline="")
+    return open(file_name, 'w', newline="")
+
+
+def mot_line(frame, track_id, ref, x0, y0, x1, y1):
+    # MOTChallenge : frame (1 based), id, left, top, width, height, confidence, x, y, z
+    return f"{frame + 1},{track_id},{x0},{y0},{x1 - x0},{y1 - y0},1,-1,-1,-1\n"
+
+
+def jsonl_line(frame, track_id, ref, x0, y0, x1, y1):
+    box = {"frame": frame, "id": track_id, "rect": {"start": [x0, y0], "end": [x1, y1]}}
+    if ref:
+        box["ref"] = ref
+    return json.dumps(box) + "\n"
+
+
+LINE_WRITERS = {"mot": mot_line, "jsonl": jsonl_line}
+
+
+def connect_read_only(database):
+    # never creates the database, the path is quoted as sqlite URIs require
+    return sqlite3.connect(f"file:{pathname2url(os.path.abspath(database))}?mode=ro", uri=True)
+
+
+def frame_bounds(database):
+    connection = connect_read_only(database)
+    try:
+        return connection.execute("SELECT min(frame), max(frame) FROM boxes WHERE track_id IS NOT NULL").fetchone()
+    finally:
+        connection.close()
+
+
+def shard_ranges(first_frame, last_frame, shard_frames):
+    return [(start, min(start + shard_frames - 1, last_frame))
+            for start in range(first_frame, last_frame + 1, shard_frames)]
+
+
+def write_shard(database, first_frame, last_frame, file_name, export_format="mot", compress=False, chunk_size=10000):
+    # every shard has its own connection, rows are streamed chunk by chunk so memory stays bounded
+    to_line = LINE_WRITERS[export_format]
+    connection = connect_read_only(database)
+    row_count = 0
+    try:
+        cursor = connection.execute(TRACK_ROWS_QUERY, (first_frame, last_frame))
+        with open_output(file_name, compress) as output:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                output.write("".join(to_line(*row) for row in rows))
+                row_count += len(rows)
+    finally:
+        connection.close()
+    return row_count
+
+
+def export_tracks(database, output_folder, export_format="mot", shard_frames=1000, compress=False, workers=4,
+                  chunk_size=10000):
+    # writes one file per range of shard_frames frames, returns [(file name, amount of boxes)]
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format}")
+    first_frame, last_frame = frame_bounds(database)
+    if first_frame is None:
+        return []
+    os.makedirs(output_folder, exist_ok=True)
+
+    extension = EXPORT_FORMATS[export_format] + (".gz" if compress else "")
+    shards = [(first, last, os.path.join(output_folder, f"tracks_{first:06d}-{last:06d}{extension}"))
+              for first, last in shard_ranges(first_frame, last_frame, shard_frames)]
+    # sqlite and zlib release the GIL, threads are enough to overlap reading, formatting and compression
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        counts = executor.map(
+            lambda shard: write_shard(database, shard[0], shard[1], shard[2], export_format, compress, chunk_size),
+            shards
+        )
+        return [(file_name, count) for (_, _, file_name), count in zip(shards, counts)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the tracks of a project store in frame range shards")
+    parser.add_argument("project", help="project directory or sqlite file")
+    parser.add_argument("output", help="folder receiving the shards")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="mot")
+    parser.add_argument("--shard-frames", type=int, default=1000, help="amount of frames per shard")
+    parser.add_argument("--gzip", action="store_true", help="compress the shards")
+    parser.add_argument("--workers", type=int, default=4, help="shards written in parallel")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows fetched and written at once")
+    args = parser.parse_args()
+
+    project_database = database_path(args.project)
+    if not os.path.isfile(project_database):
+        parser.error(f"no project store at {project_database}")
+    for file_name, count in export_tracks(project_database, args.output, args.format, args.shard_frames, args.gzip,
+                                          args.workers, args.chunk_size):
+        print(f"{file_name} : {count} boxes")
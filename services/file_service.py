@@ -1,12 +1,27 @@
 import os
+import threading
 
 from readers.folder_reader import FolderReader
 from readers.tiff_reader import TiffReader
+from readers.http_reader import HttpFolderReader, HttpTiffReader
 
 
-def open_file(caller, path):
-    if os.path.isdir(path):
-        return FolderReader(caller, path)
+def open_file(caller, path, background=False):
+    reader = None
+    if path.startswith("http://") or path.startswith("https://"):
+        if path[-4:] == '.tif' or path[-5:] == '.tiff':
+            reader = HttpTiffReader(caller, path)
+        else:
+            reader = HttpFolderReader(caller, path)
+    elif os.path.isdir(path):
+        reader = FolderReader(caller, path)
     elif os.path.isfile(path):
         if path[-4:] == '.tif' or path[-5:] == '.tiff':
-            return TiffReader(caller, path)
+            reader = TiffReader(caller, path)
+
+    if reader is not None:
+        if background:
+            threading.Thread(target=reader.safe_load, daemon=True).start()
+        else:
+            reader.load()
+    return reader
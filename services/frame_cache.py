@@ -0,0 +1,133 @@
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class FrameCache(object):
+    def __init__(self, raw_budget=256 << 20, compressed_budget=512 << 20, codec="zlib", level=1):
+        # most recent frames stay decoded in the raw tier, older ones are losslessly compressed in the second tier
+        # budgets are in bytes, None means unbounded
+        if codec == "lz4" and lz4 is None:
+            print("lz4 is not installed, falling back to zlib")
+            codec = "zlib"
+        if codec not in ("zlib", "lz4", "png"):
+            raise ValueError(f"Unknown codec {codec}")
+        self.codec = codec
+        self.level = level
+
+        self.raw_budget = raw_budget
+        self.compressed_budget = compressed_budget
+        self.raw = OrderedDict()
+        self.compressed = OrderedDict()
+        self.raw_size = 0
+        self.compressed_size = 0
+
+        self.counters = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.counters = {
+            "raw_hits": 0,
+            "compressed_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "compressed_input_bytes": 0,
+            "compressed_output_bytes": 0,
+            "compress_time": 0.,
+            "decompress_time": 0.
+        }
+
+    def compress(self, image):
+        if self.codec == "png":
+            return cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, self.level])[1].tobytes()
+        data = np.ascontiguousarray(image).tobytes()
+        if self.codec == "lz4":
+            return lz4.frame.compress(data, compression_level=self.level)
+        return zlib.compress(data, self.level)
+
+    def decompress(self, payload, shape, dtype):
+        if self.codec == "png":
+            return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED).reshape(shape)
+        if self.codec == "lz4":
+            data = lz4.frame.decompress(payload)
+        else:
+            data = zlib.decompress(payload)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def get(self, key):
+        # (image, reference) or None, returned images must be treated as read only
+        if key in self.raw:
+            self.raw.move_to_end(key)
+            self.counters["raw_hits"] += 1
+            return self.raw[key]
+        if key in self.compressed:
+            payload, shape, dtype, reference = self.compressed.pop(key)
+            self.compressed_size -= len(payload)
+            start = time.perf_counter()
+            image = self.decompress(payload, shape, dtype)
+            self.counters["decompress_time"] += time.perf_counter() - start
+            self.counters["compressed_hits"] += 1
+            self.put(key, image, reference)
+            return image, reference
+        self.counters["misses"] += 1
+        return None
+
+    def put(self, key, image, reference):
+        if image is None:
+            return
+        self.discard(key)
+        self.raw[key] = (image, reference)
+        self.raw_size += image.nbytes
+
+        while self.raw_budget is not None and self.raw_size > self.raw_budget and len(self.raw) > 0:
+            old_key, (old_image, old_reference) = self.raw.popitem(last=False)
+            self.raw_size -= old_image.nbytes
+            self.demote(old_key, old_image, old_reference)
+
+    def demote(self, key, image, reference):
+        if self.compressed_budget is not None and self.compressed_budget <= 0:
+            self.counters["evictions"] += 1
+            return
+        start = time.perf_counter()
+        payload = self.compress(image)
+        self.counters["compress_time"] += time.perf_counter() - start
+        self.counters["compressed_input_bytes"] += image.nbytes
+        self.counters["compressed_output_bytes"] += len(payload)
+
+        self.compressed[key] = (payload, image.shape, image.dtype, reference)
+        self.compressed_size += len(payload)
+        while self.compressed_budget is not None and self.compressed_size > self.compressed_budget:
+            _, (old_payload, _, _, _) = self.compressed.popitem(last=False)
+            self.compressed_size -= len(old_payload)
+            self.counters["evictions"] += 1
+
+    def discard(self, key):
+        if key in self.raw:
+            self.raw_size -= self.raw.pop(key)[0].nbytes
+        if key in self.compressed:
+            self.compressed_size -= len(self.compressed.pop(key)[0])
+
+    def clear(self):
+        self.raw.clear()
+        self.compressed.clear()
+        self.raw_size = 0
+        self.compressed_size = 0
+
+    def stats(self):
+        stats = dict(self.counters)
+        requests = stats["raw_hits"] + stats["compressed_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["raw_hits"] + stats["compressed_hits"]) / max(requests, 1)
+        stats["compression_ratio"] = stats["compressed_input_bytes"] / max(stats["compressed_output_bytes"], 1)
+        stats["raw_frames"] = len(self.raw)
+        stats["raw_bytes"] = self.raw_size
+        stats["compressed_frames"] = len(self.compressed)
+        stats["compressed_bytes"] = self.compressed_size
+        return stats
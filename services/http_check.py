@@ -0,0 +1,135 @@
+import os
+import sys
+import tempfile
+import argparse
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+import cv2
+
+from services.http_service import HttpClient
+from readers.folder_reader import FolderReader
+from readers.http_reader import HttpFolderReader, HttpTiffReader
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # http.server with single byte range support, as served by object stores
+    requests = 0
+
+    def send_head(self):
+        RangeRequestHandler.requests += 1
+        byte_range = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not self.server.ranges or byte_range is None or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        first, last = byte_range[len("bytes="):].split("-")
+        first, last = int(first), min(int(last), size - 1)
+        if first >= size:
+            self.send_error(416)
+            return None
+        source = open(path, 'rb')
+        source.seek(first)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.end_headers()
+        self.range_length = last - first + 1
+        return source
+
+    def copyfile(self, source, outputfile):
+        if getattr(self, "range_length", None) is None:
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(self.range_length))
+        self.range_length = None
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(folder, ranges=True):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeRequestHandler, directory=folder))
+    server.ranges = ranges
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def make_samples(folder, pages=20):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, (48, 64), dtype=np.uint8) for _ in range(pages)]
+    cv2.imwritemulti(os.path.join(folder, "stack.tif"), frames)
+    os.makedirs(os.path.join(folder, "frames dir"))
+    for idx in range(5):
+        cv2.imwrite(os.path.join(folder, "frames dir", f"frame {idx}.png"), rng.integers(0, 255, (48, 64, 3), dtype=np.uint8))
+
+
+def check(folder, ranges):
+    # returns the failures of the HTTP readers against the local files
+    failures = []
+    server, url = serve(folder, ranges)
+    cache_folder = tempfile.mkdtemp()
+    try:
+        _, pages = cv2.imreadmulti(os.path.join(folder, "stack.tif"), flags=cv2.IMREAD_UNCHANGED)
+        # twice : directories walked over HTTP, then read back from the disk cache
+        for attempt in ("walk", "cached"):
+            RangeRequestHandler.requests = 0
+            reader = HttpTiffReader(None, url + "stack.tif", client=HttpClient(cache_folder=cache_folder))
+            if RangeRequestHandler.requests != 0:
+                failures.append(f"tiff ({attempt}) : {RangeRequestHandler.requests} requests before load()")
+            reader.load()
+            if reader.get_frame_count() != len(pages):
+                failures.append(f"tiff ({attempt}) : {reader.get_frame_count()} pages instead of {len(pages)}")
+            for idx in range(min(reader.get_frame_count(), len(pages))):
+                if not np.array_equal(reader.get_frame(idx)[0], pages[idx]):
+                    failures.append(f"tiff ({attempt}) : page {idx} differs")
+
+        # the stack changes on the server : the cached pages and directories must not be used anymore
+        pages = [255 - page for page in pages]
+        stack = os.path.join(folder, "stack.tif")
+        cv2.imwritemulti(stack, pages)
+        os.utime(stack, (os.path.getmtime(stack) + 2, os.path.getmtime(stack) + 2))
+        reader = HttpTiffReader(None, url + "stack.tif", client=HttpClient(cache_folder=cache_folder))
+        reader.load()
+        if any(not np.array_equal(reader.get_frame(idx)[0], pages[idx]) for idx in range(len(pages))):
+            failures.append("tiff (changed) : pages of the previous version were returned")
+
+        # the disk cache stays within its budget, the least recently used files go first
+        client = HttpClient(cache_folder=cache_folder, chunk_size=1024, cache_budget=8 * 1024)
+        client.read_range(url + "stack.tif", 0, client.size(url + "stack.tif"))
+        client.evict()
+        cached = sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(cache_folder)
+                     for name in names if name != "validator")
+        if cached > client.cache_budget:
+            failures.append(f"cache : {cached} bytes kept for a budget of {client.cache_budget}")
+
+        local = FolderReader(None, os.path.join(folder, "frames dir"))
+        reader = HttpFolderReader(None, url + "frames%20dir/", client=HttpClient(cache_folder=cache_folder))
+        reader.load()
+        if reader.get_frame_count() != local.get_frame_count():
+            failures.append(f"folder : {reader.get_frame_count()} frames instead of {local.get_frame_count()}")
+        for idx in range(reader.get_frame_count()):
+            image, reference = reader.get_frame(idx)
+            local_idx = local.frame_index(reference)
+            if local_idx is None or not np.array_equal(image, local.get_frame(local_idx)[0]):
+                failures.append(f"folder : frame {reference} differs")
+    finally:
+        server.shutdown()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the HTTP readers against a local http.server")
+    parser.parse_args()
+
+    sample_folder = tempfile.mkdtemp()
+    make_samples(sample_folder)
+    all_failures = []
+    for with_ranges in (True, False):
+        check_failures = check(sample_folder, with_ranges)
+        print(f"server {'with' if with_ranges else 'without'} range requests : "
+              f"{'ok' if len(check_failures) == 0 else ', '.join(check_failures)}")
+        all_failures += check_failures
+    sys.exit(0 if len(all_failures) == 0 else 1)
@@ -0,0 +1,223 @@
+import os
+import hashlib
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HttpClient(object):
+    def __init__(self, cache_folder=None, chunk_size=1 << 20, workers=8, timeout=30., cache_budget=4 << 30):
+        if cache_folder is None:
+            cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "manual_annotation_python")
+        self.cache_folder = cache_folder
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        # bytes kept on disk, the least recently used cache files are removed past it
+        self.cache_budget = cache_budget
+        self.written = 0
+        self.evicted = False
+        self.evict_lock = threading.Lock()
+
+        # one keep-alive connection per (thread, host), requests of a worker reuse it
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(workers)
+
+        # urls checked against their cached version in this session, with their size
+        self.sizes = {}
+        self.size_lock = threading.Lock()
+
+    def connection(self, scheme, host):
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+        connection = connections.get((scheme, host))
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(host, timeout=self.timeout)
+            connections[(scheme, host)] = connection
+        return connection
+
+    def request(self, url, headers=None, method="GET"):
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        connection = self.connection(parts.scheme, parts.netloc)
+        for attempt in range(2):
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # the server closed a kept alive connection, retry once on a new one
+                connection.close()
+                if attempt == 1:
+                    raise
+        if response.status >= 400:
+            raise OSError(f"{method} {url} : {response.status} {response.reason}")
+        return response.status, response.headers, body
+
+    def cache_path(self, url, name):
+        folder = os.path.join(self.cache_folder, hashlib.sha1(url.encode()).hexdigest())
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, name)
+
+    def read_cache(self, url, name):
+        # call revalidate(url) first, the entries of a file that changed on the server are dropped there
+        path = self.cache_path(url, name)
+        try:
+            with open(path, 'rb') as cache_file:
+                data = cache_file.read()
+        except FileNotFoundError:
+            # never cached, or evicted
+            return None
+        # the modification time orders the files for eviction
+        os.utime(path)
+        return data
+
+    def write_cache(self, url, name, data):
+        # written aside then renamed, so a concurrent reader never sees a partial file
+        path = self.cache_path(url, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, path)
+
+        self.written += len(data)
+        if self.written > self.cache_budget // 10:
+            self.evict()
+
+    def evict(self):
+        # least recently used files first, until the cache fits in cache_budget
+        with self.evict_lock:
+            self.written = 0
+            files = []
+            for folder, _, names in os.walk(self.cache_folder):
+                for name in names:
+                    if name == "validator" or name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(folder, name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(folder, name)))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.cache_budget:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def revalidate(self, url):
+        # once per session and url : the cached entries belong to the version of the file identified by its ETag,
+        # or Last-Modified and size, they are dropped when the file changed on the server
+        with self.size_lock:
+            if url in self.sizes:
+                return self.sizes[url]
+        if not self.evicted:
+            self.evicted = True
+            self.evict()
+        _, headers, _ = self.request(url, method="HEAD")
+        size = headers.get("Content-Length")
+        validator = f"{headers.get('ETag') or headers.get('Last-Modified') or ''} {size}".encode()
+        if self.read_cache(url, "validator") != validator:
+            folder = os.path.dirname(self.cache_path(url, "validator"))
+            for name in os.listdir(folder):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except FileNotFoundError:
+                    pass
+            self.write_cache(url, "validator", validator)
+        with self.size_lock:
+            self.sizes[url] = int(size) if size is not None else None
+            return self.sizes[url]
+
+    def get(self, url):
+        self.revalidate(url)
+        data = self.read_cache(url, "file")
+        if data is None:
+            _, _, data = self.request(url)
+            self.write_cache(url, "file", data)
+        return data
+
+    def prefetch(self, url):
+        return self.executor.submit(self.get, url)
+
+    def prefetch_range(self, url, offset, length):
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+        return [self.executor.submit(self.chunk, url, chunk_idx) for chunk_idx in range(first, last + 1)]
+
+    def size(self, url):
+        size = self.revalidate(url)
+        if size is not None:
+            return size
+        # no Content-Length in the HEAD reply, the first chunk tells the size
+        status, headers, body = self.request(url, {"Range": f"bytes=0-{self.chunk_size - 1}"})
+        if status == 206:
+            size = int(headers["Content-Range"].rsplit("/", 1)[1])
+            self.write_cache(url, self.chunk_name(0), body)
+        else:
+            size = len(body)
+            self.store_chunks(url, body)
+        with self.size_lock:
+            self.sizes[url] = size
+        return size
+
+    def store_chunks(self, url, body):
+        for chunk_idx in range(0, max(1, (len(body) + self.chunk_size - 1) // self.chunk_size)):
+            self.write_cache(url, self.chunk_name(chunk_idx),
+                             body[chunk_idx * self.chunk_size:(chunk_idx + 1) * self.chunk_size])
+
+    def chunk_name(self, chunk_idx):
+        return f"{self.chunk_size}_{chunk_idx}.chunk"
+
+    def chunk(self, url, chunk_idx):
+        self.revalidate(url)
+        data = self.read_cache(url, self.chunk_name(chunk_idx))
+        if data is None:
+            first = chunk_idx * self.chunk_size
+            last = min(first + self.chunk_size, self.size(url)) - 1
+            status, _, data = self.request(url, {"Range": f"bytes={first}-{last}"})
+            if status == 200:
+                # ranges got ignored, the whole file came back
+                self.store_chunks(url, data)
+                data = data[first:last + 1]
+            else:
+                self.write_cache(url, self.chunk_name(chunk_idx), data)
+        return data
+
+    def fetch_range(self, url, offset, length):
+        # small reads (TIFF directories) are requested as they are instead of downloading whole chunks,
+        # unless these chunks are already cached
+        self.revalidate(url)
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+        if all(os.path.isfile(self.cache_path(url, self.chunk_name(i))) for i in range(first, last + 1)):
+            return self.read_range(url, offset, length)
+        status, _, data = self.request(url, {"Range": f"bytes={offset}-{offset + length - 1}"})
+        if status == 200:
+            # ranges got ignored, the whole file came back
+            self.store_chunks(url, data)
+            with self.size_lock:
+                self.sizes[url] = len(data)
+            data = data[offset:offset + length]
+        return data
+
+    def read_range(self, url, offset, length):
+        # the chunks covering the range are fetched in parallel, each one only once thanks to the disk cache
+        if length <= 0:
+            return b""
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+        if first == last:
+            data = self.chunk(url, first)
+        else:
+            data = b"".join(self.executor.map(lambda chunk_idx: self.chunk(url, chunk_idx), range(first, last + 1)))
+        start = offset - first * self.chunk_size
+        return data[start:start + length]
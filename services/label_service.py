@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class LabelTable(object):
+    def __init__(self, names=()):
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.intern(name)
+
+    def intern(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+        return code
+
+    def name(self, code):
+        return self.names[code]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class AttributeTable(LabelTable):
+    max_attributes = 32
+
+    def intern(self, name):
+        if name not in self.codes and len(self.names) >= self.max_attributes:
+            raise ValueError(f"At most {self.max_attributes} attributes are supported")
+        return super().intern(name)
+
+    def encode(self, names):
+        mask = 0
+        for name in names:
+            mask |= 1 << self.intern(name)
+        return mask
+
+    def decode(self, mask):
+        return [name for code, name in enumerate(self.names) if mask & (1 << code)]
+
+
+class ObjectArray(object):
+    def __init__(self, capacity=8):
+        self.rects = np.zeros((capacity, 4), dtype=np.int32)
+        self.class_ids = np.zeros(capacity, dtype=np.uint16)
+        self.attributes = np.zeros(capacity, dtype=np.uint32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def grow(self, capacity):
+        for name in ("rects", "class_ids", "attributes"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def append(self, start, end, class_id=0, attributes=0):
+        if self.count == len(self.rects):
+            self.grow(max(8, 2 * self.count))
+        self.rects[self.count] = (start[0], start[1], end[0], end[1])
+        self.class_ids[self.count] = class_id
+        self.attributes[self.count] = attributes
+        self.count += 1
+
+    def pop(self):
+        if self.count > 0:
+            self.count -= 1
+
+    def copy(self):
+        other = ObjectArray(max(1, self.count))
+        other.rects[:self.count] = self.rects[:self.count]
+        other.class_ids[:self.count] = self.class_ids[:self.count]
+        other.attributes[:self.count] = self.attributes[:self.count]
+        other.count = self.count
+        return other
+
+    def class_counts(self, class_count):
+        return np.bincount(self.class_ids[:self.count], minlength=class_count)
+
+    def to_list(self, classes, attributes):
+        objects = []
+        for rect, class_id, mask in zip(self.rects[:self.count].tolist(),
+                                        self.class_ids[:self.count].tolist(),
+                                        self.attributes[:self.count].tolist()):
+            objects.append({
+                "rect": {
+                    "start": (rect[0], rect[1]),
+                    "end": (rect[2], rect[3])
+                },
+                "class": classes.name(class_id),
+                "attributes": attributes.decode(mask)
+            })
+        return objects
+
+    @classmethod
+    def from_list(cls, objects, classes, attributes, default_class=0):
+        array = cls(max(1, len(objects)))
+        for obj in objects:
+            class_id = classes.intern(obj["class"]) if "class" in obj else default_class
+            array.append(obj["rect"]["start"], obj["rect"]["end"], class_id,
+                         attributes.encode(obj.get("attributes", [])))
+        return array
@@ -0,0 +1,453 @@
+import os
+import json
+import time
+import socket
+import itertools
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    first_frame INTEGER NOT NULL,
+    last_frame INTEGER NOT NULL,
+    annotator TEXT NOT NULL,
+    claimed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    annotator TEXT NOT NULL,
+    local_id INTEGER NOT NULL,
+    UNIQUE (annotator, local_id)
+);
+CREATE TABLE IF NOT EXISTS boxes (
+    id INTEGER PRIMARY KEY,
+    frame INTEGER,
+    ref TEXT,
+    track_id INTEGER REFERENCES tracks (id),
+    class TEXT,
+    attributes TEXT,
+    x0 INTEGER NOT NULL,
+    y0 INTEGER NOT NULL,
+    x1 INTEGER NOT NULL,
+    y1 INTEGER NOT NULL,
+    annotator TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS boxes_frame ON boxes (frame);
+CREATE INDEX IF NOT EXISTS boxes_ref ON boxes (ref);
+CREATE INDEX IF NOT EXISTS boxes_track ON boxes (track_id, frame);
+CREATE INDEX IF NOT EXISTS boxes_size ON boxes (max(x1 - x0, y1 - y0));
+CREATE VIRTUAL TABLE IF NOT EXISTS boxes_rtree USING rtree (id, min_frame, max_frame, min_x, max_x, min_y, max_y);
+CREATE TRIGGER IF NOT EXISTS boxes_rtree_insert AFTER INSERT ON boxes WHEN new.frame IS NOT NULL BEGIN
+    INSERT INTO boxes_rtree VALUES (new.id, new.frame, new.frame, new.x0, new.x1, new.y0, new.y1);
+END;
+CREATE TRIGGER IF NOT EXISTS boxes_rtree_delete AFTER DELETE ON boxes BEGIN
+    DELETE FROM boxes_rtree WHERE id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS boxes_rtree_update AFTER UPDATE ON boxes BEGIN
+    DELETE FROM boxes_rtree WHERE id = old.id;
+    INSERT INTO boxes_rtree SELECT new.id, new.frame, new.frame, new.x0, new.x1, new.y0, new.y1 WHERE new.frame IS NOT NULL;
+END;
+"""
+
+# columns of the rows returned by the box queries
+BOX_COLUMNS = ("id", "frame", "ref", "track_id", "class", "x0", "y0", "x1", "y1", "annotator")
+
+
+def database_path(path):
+    # a directory (existing or without extension) holds the database, otherwise path is the database itself
+    if os.path.isdir(path) or os.path.splitext(path)[1] == "":
+        return os.path.join(path, "project.sqlite")
+    return path
+
+
+class ProjectStore(object):
+    def __init__(self, path, annotator=None, timeout=60.0, claim_timeout=1800.0):
+        self.path = database_path(path)
+        if self.path != path:
+            os.makedirs(path, exist_ok=True)
+
+        if annotator is None:
+            annotator = f"{socket.gethostname()}-{os.getpid()}"
+        self.annotator = annotator
+        # claims of other annotators not refreshed for claim_timeout seconds are stale (crashed process), and taken over
+        self.claim_timeout = claim_timeout
+
+        # autocommit mode, every write goes through transaction()
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.connection.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.transaction() as connection:
+            had_rtree = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'boxes_rtree'"
+            ).fetchone() is not None
+            statement = ""
+            for line in SCHEMA.splitlines(keepends=True):
+                statement += line
+                if sqlite3.complete_statement(statement):
+                    connection.execute(statement)
+                    statement = ""
+            if not had_rtree:
+                # projects created before the spatial index
+                connection.execute(
+                    "INSERT INTO boxes_rtree SELECT id, frame, frame, x0, x1, y0, y1 FROM boxes WHERE frame IS NOT NULL"
+                )
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent annotators queue instead of deadlocking
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def expire_claims(self, connection):
+        # only work in progress expires, 'done' rows record finished frames for good
+        connection.execute(
+            "DELETE FROM claims WHERE kind != 'done' AND annotator != ? AND claimed_at < ?",
+            (self.annotator, time.time() - self.claim_timeout)
+        )
+
+    def mark_done(self, connection, frames):
+        # finished frames are never handed out again, whatever happens to the claims
+        frames = [(frame, frame) for frame in set(frames) if frame is not None]
+        connection.executemany(
+            "DELETE FROM claims WHERE kind = 'done' AND first_frame = ? AND last_frame = ?", frames
+        )
+        connection.executemany(
+            "INSERT INTO claims (kind, first_frame, last_frame, annotator, claimed_at) VALUES ('done', ?, ?, ?, ?)",
+            [(first, last, self.annotator, time.time()) for first, last in frames]
+        )
+
+    def refresh_claims(self, connection=None):
+        # every write of this annotator keeps its claims alive
+        connection = self.connection if connection is None else connection
+        connection.execute(
+            "UPDATE claims SET claimed_at = ? WHERE kind != 'done' AND annotator = ?", (time.time(), self.annotator)
+        )
+
+    def claim_frames(self, first, count):
+        # claims up to count frames from the first frame >= first not claimed or finished by another annotator
+        with self.transaction() as connection:
+            self.expire_claims(connection)
+            self.refresh_claims(connection)
+            rows = connection.execute(
+                "SELECT first_frame, last_frame FROM claims "
+                "WHERE kind IN ('frames', 'done') AND annotator != ? AND last_frame >= ? ORDER BY first_frame",
+                (self.annotator, first)
+            ).fetchall()
+
+            start = first
+            end = None
+            for claim_first, claim_last in rows:
+                if claim_first <= start:
+                    start = max(start, claim_last + 1)
+                else:
+                    end = claim_first - 1
+                    break
+            last = start + count - 1
+            if end is not None:
+                last = min(last, end)
+
+            connection.execute(
+                "INSERT INTO claims (kind, first_frame, last_frame, annotator, claimed_at) VALUES ('frames', ?, ?, ?, ?)",
+                (start, last, self.annotator, time.time())
+            )
+        return start, last
+
+    def release_frames(self, first=0):
+        # gives back the claimed frames >= first, frames before stay owned by this annotator
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM claims WHERE kind = 'frames' AND annotator = ? AND first_frame >= ?",
+                (self.annotator, first)
+            )
+            connection.execute(
+                "UPDATE claims SET last_frame = ? WHERE kind = 'frames' AND annotator = ? AND last_frame >= ?",
+                (first - 1, self.annotator, first)
+            )
+
+    def frame_owner(self, frame):
+        row = self.connection.execute(
+            "SELECT annotator FROM claims WHERE kind IN ('frames', 'done') AND first_frame <= ? AND last_frame >= ? "
+            "AND (kind = 'done' OR annotator = ? OR claimed_at >= ?) ORDER BY kind = 'frames', claimed_at LIMIT 1",
+            (frame, frame, self.annotator, time.time() - self.claim_timeout)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def claim_track(self, track_id):
+        # False when another annotator is editing the track
+        with self.transaction() as connection:
+            self.expire_claims(connection)
+            row = connection.execute(
+                "SELECT annotator FROM claims WHERE kind = 'track' AND first_frame = ?", (track_id,)
+            ).fetchone()
+            if row is not None:
+                return row[0] == self.annotator
+            connection.execute(
+                "INSERT INTO claims (kind, first_frame, last_frame, annotator, claimed_at) VALUES ('track', ?, ?, ?, ?)",
+                (track_id, track_id, self.annotator, time.time())
+            )
+        return True
+
+    def release_track(self, track_id):
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM claims WHERE kind = 'track' AND first_frame = ? AND annotator = ?",
+                (track_id, self.annotator)
+            )
+
+    def release_tracks(self):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM claims WHERE kind = 'track' AND annotator = ?", (self.annotator,))
+
+    def claimed_tracks(self):
+        # {track_id: annotator} of the tracks other annotators are editing
+        rows = self.connection.execute(
+            "SELECT first_frame, annotator FROM claims WHERE kind = 'track' AND annotator != ? AND claimed_at >= ?",
+            (self.annotator, time.time() - self.claim_timeout)
+        )
+        return dict(rows)
+
+    def new_local_ids(self, count=1, annotator=None):
+        # local ids never used by this annotator, so sessions sharing an annotator name do not overwrite each other
+        annotator = self.annotator if annotator is None else annotator
+        with self.transaction() as connection:
+            first = connection.execute(
+                "SELECT coalesce(max(local_id) + 1, 0) FROM tracks WHERE annotator = ?", (annotator,)
+            ).fetchone()[0]
+            connection.executemany(
+                "INSERT INTO tracks (annotator, local_id) VALUES (?, ?)", [(annotator, i) for i in range(first, first + count)]
+            )
+        return list(range(first, first + count))
+
+    def global_track_id(self, connection, local_id, annotator=None):
+        # global track id of a local one, created on first use so ids never collide between annotators
+        annotator = self.annotator if annotator is None else annotator
+        row = connection.execute(
+            "SELECT id FROM tracks WHERE annotator = ? AND local_id = ?", (annotator, local_id)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        return connection.execute(
+            "INSERT INTO tracks (annotator, local_id) VALUES (?, ?)", (annotator, local_id)
+        ).lastrowid
+
+    def commit_tracks(self, cells, frames=None, annotator=None, done=False):
+        # cells is a list of (local_id, cell), only the given frames are replaced when frames is not None
+        # done marks these frames as finished (end of a multi track pass frame)
+        annotator = self.annotator if annotator is None else annotator
+        track_ids = []
+        with self.transaction() as connection:
+            if annotator == self.annotator:
+                self.refresh_claims(connection)
+            if done and frames is not None:
+                self.mark_done(connection, frames)
+            for local_id, cell in cells:
+                track_id = self.global_track_id(connection, local_id, annotator)
+                track_ids.append(track_id)
+                if frames is None:
+                    connection.execute("DELETE FROM boxes WHERE track_id = ?", (track_id,))
+                    to_insert = cell.items()
+                else:
+                    connection.executemany(
+                        "DELETE FROM boxes WHERE track_id = ? AND frame = ?", [(track_id, f) for f in frames]
+                    )
+                    to_insert = [(f, cell[f]) for f in frames if cell.get(f) is not None]
+                connection.executemany(
+                    "INSERT INTO boxes (frame, ref, track_id, x0, y0, x1, y1, annotator) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(int(frame), v.get("ref"), track_id,
+                      int(v["rect"]["start"][0]), int(v["rect"]["start"][1]),
+                      int(v["rect"]["end"][0]), int(v["rect"]["end"][1]),
+                      annotator) for frame, v in to_insert]
+                )
+        return track_ids
+
+    def commit_track(self, local_id, cell, frames=None):
+        return self.commit_tracks([(local_id, cell)], frames)[0]
+
+    def bulk_commit_tracks(self, cells, batch_size=10000, annotator=None):
+        # one transaction per batch of about batch_size boxes, so other annotators are never blocked for long
+        track_ids = []
+        batch, batch_boxes = [], 0
+        for local_id, cell in cells:
+            batch.append((local_id, cell))
+            batch_boxes += len(cell)
+            if batch_boxes >= batch_size:
+                track_ids += self.commit_tracks(batch, annotator=annotator)
+                batch, batch_boxes = [], 0
+        if len(batch) > 0:
+            track_ids += self.commit_tracks(batch, annotator=annotator)
+        return track_ids
+
+    def commit_detections(self, frame, ref, objects):
+        # objects as saved by DetectionManager, replaces what this annotator stored for the frame
+        self.bulk_commit_detections([(frame, ref, objects)])
+
+    def bulk_commit_detections(self, frames, batch_size=10000):
+        # frames is an iterable of (frame, ref, objects), one transaction per batch of about batch_size boxes
+        batch, batch_boxes = [], 0
+        for frame, ref, objects in frames:
+            batch.append((frame, ref, objects))
+            batch_boxes += len(objects)
+            if batch_boxes >= batch_size:
+                self.write_detections(batch)
+                batch, batch_boxes = [], 0
+        if len(batch) > 0:
+            self.write_detections(batch)
+
+    def write_detections(self, frames):
+        with self.transaction() as connection:
+            self.refresh_claims(connection)
+            self.mark_done(connection, [frame for frame, _, _ in frames])
+            connection.executemany(
+                "DELETE FROM boxes WHERE track_id IS NULL AND annotator = ? AND ref = ?",
+                [(self.annotator, ref) for _, ref, _ in frames]
+            )
+            connection.executemany(
+                "INSERT INTO boxes (frame, ref, class, attributes, x0, y0, x1, y1, annotator) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(frame, ref, obj.get("class"), json.dumps(obj.get("attributes", [])),
+                  int(obj["rect"]["start"][0]), int(obj["rect"]["start"][1]),
+                  int(obj["rect"]["end"][0]), int(obj["rect"]["end"][1]),
+                  self.annotator) for frame, ref, objects in frames for obj in objects]
+            )
+
+    def boxes_in_frame(self, frame, exclude_annotator=None):
+        return self.connection.execute(
+            f"SELECT {', '.join(BOX_COLUMNS)} FROM boxes WHERE frame = ? AND annotator IS NOT ?",
+            (frame, exclude_annotator)
+        ).fetchall()
+
+    def query_boxes(self, first_frame=None, last_frame=None, region=None, min_size=None, max_size=None):
+        # region is (x0, y0, x1, y1), boxes intersecting it are returned, size is the longest side of a box
+        conditions, parameters = [], []
+        if first_frame is not None or last_frame is not None or region is not None:
+            source = "boxes_rtree JOIN boxes ON boxes.id = boxes_rtree.id"
+            if first_frame is not None:
+                conditions.append("boxes_rtree.max_frame >= ?")
+                parameters.append(first_frame)
+            if last_frame is not None:
+                conditions.append("boxes_rtree.min_frame <= ?")
+                parameters.append(last_frame)
+            if region is not None:
+                conditions += ["boxes_rtree.max_x >= ?", "boxes_rtree.min_x <= ?",
+                               "boxes_rtree.max_y >= ?", "boxes_rtree.min_y <= ?"]
+                parameters += [region[0], region[2], region[1], region[3]]
+        else:
+            source = "boxes"
+        if min_size is not None:
+            conditions.append("max(x1 - x0, y1 - y0) >= ?")
+            parameters.append(min_size)
+        if max_size is not None:
+            conditions.append("max(x1 - x0, y1 - y0) < ?")
+            parameters.append(max_size)
+
+        query = f"SELECT {', '.join('boxes.' + c for c in BOX_COLUMNS)} FROM {source}"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        return self.connection.execute(query + " ORDER BY boxes.frame, boxes.id", parameters).fetchall()
+
+    def query_tracks(self, min_length=None, max_length=None):
+        # (track_id, amount of annotated frames, first frame, last frame) for the tracks within the length bounds
+        conditions, parameters = [], []
+        if min_length is not None:
+            conditions.append("count(*) >= ?")
+            parameters.append(min_length)
+        if max_length is not None:
+            conditions.append("count(*) < ?")
+            parameters.append(max_length)
+        query = "SELECT track_id, count(*), min(frame), max(frame) FROM boxes WHERE track_id IS NOT NULL GROUP BY track_id"
+        if len(conditions) > 0:
+            query += " HAVING " + " AND ".join(conditions)
+        return self.connection.execute(query, parameters).fetchall()
+
+    def load_tracks(self):
+        return dict(self.iter_tracks())
+
+    def load_detections(self):
+        detections = {}
+        rows = self.connection.execute(
+            "SELECT ref, class, attributes, x0, y0, x1, y1 FROM boxes WHERE track_id IS NULL ORDER BY frame, id"
+        )
+        for ref, class_name, attributes, x0, y0, x1, y1 in rows:
+            obj = {"rect": {"start": (x0, y0), "end": (x1, y1)}}
+            if class_name is not None:
+                obj["class"] = class_name
+                obj["attributes"] = json.loads(attributes)
+            detections.setdefault(ref, []).append(obj)
+        return detections
+
+    def import_tracking_save(self, file_name):
+        # tracks of a TrackingManager save get their own global ids, importing the same file twice is a no-op
+        with open(file_name, 'r') as json_file:
+            data = json.load(json_file)
+        annotator = f"import:{os.path.abspath(file_name)}"
+        cells = [(el["id"], {int(k): v for k, v in el["timestamps"].items()}) for el in data]
+        return self.bulk_commit_tracks(cells, annotator=annotator)
+
+    def iter_tracks(self):
+        # (track_id, cell) one track at a time, rows come ordered by the boxes_track index
+        rows = self.connection.execute(
+            "SELECT track_id, frame, ref, x0, y0, x1, y1 FROM boxes WHERE track_id IS NOT NULL ORDER BY track_id, frame"
+        )
+        for track_id, track_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            cell = {}
+            for _, frame, ref, x0, y0, x1, y1 in track_rows:
+                cell[frame] = {"rect": {"start": (x0, y0), "end": (x1, y1)}}
+                if ref:
+                    cell[frame]["ref"] = ref
+            yield track_id, cell
+
+    def export_tracking(self, file_name):
+        from services.export_service import write_json_list
+        with open(file_name, 'w') as json_file:
+            write_json_list(json_file, ({"id": track_id, "timestamps": cell} for track_id, cell in self.iter_tracks()))
+
+    def export_detections(self, file_name):
+        with open(file_name, 'w') as json_file:
+            json.dump(self.load_detections(), json_file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge annotations into a project store and export them")
+    parser.add_argument("project", help="project directory or sqlite file")
+    parser.add_argument("--import-tracking", nargs="*", default=[], help="TrackingManager saves to merge")
+    parser.add_argument("--export-tracking", help="write all tracks, with merged ids, to this file")
+    parser.add_argument("--export-detections", help="write all detections to this file")
+    parser.add_argument("--frames", nargs=2, type=int, metavar=("FIRST", "LAST"), help="list the boxes of these frames")
+    parser.add_argument("--region", nargs=4, type=int, metavar=("X0", "Y0", "X1", "Y1"),
+                        help="list the boxes intersecting this region")
+    parser.add_argument("--min-size", type=int, help="list the boxes whose longest side is at least this")
+    parser.add_argument("--max-size", type=int, help="list the boxes whose longest side is smaller than this")
+    parser.add_argument("--short-tracks", type=int, metavar="LENGTH", help="list the tracks shorter than this")
+    args = parser.parse_args()
+
+    store = ProjectStore(args.project)
+    for save_file in args.import_tracking:
+        track_ids = store.import_tracking_save(save_file)
+        print(f"{save_file} : {len(track_ids)} tracks imported")
+    if args.export_tracking:
+        store.export_tracking(args.export_tracking)
+    if args.export_detections:
+        store.export_detections(args.export_detections)
+    if args.frames or args.region or args.min_size is not None or args.max_size is not None:
+        first_frame, last_frame = args.frames if args.frames else (None, None)
+        print(",".join(BOX_COLUMNS))
+        for row in store.query_boxes(first_frame, last_frame, args.region, args.min_size, args.max_size):
+            print(",".join("" if v is None else str(v) for v in row))
+    if args.short_tracks is not None:
+        print("track_id,frames,first_frame,last_frame")
+        for row in store.query_tracks(max_length=args.short_tracks):
+            print(",".join(str(v) for v in row))
+    store.close()
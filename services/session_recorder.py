@@ -0,0 +1,57 @@
+import json
+import time
+import hashlib
+
+
+class SessionRecorder(object):
+    def __init__(self, file_name=None):
+        # without file_name nothing is written, only the digests of the saves are kept (used when replaying)
+        self.file = open(file_name, 'w') if file_name is not None else None
+        self.start = time.perf_counter()
+        self.saves = []
+
+    def write(self, line):
+        # buffered, flushed on saves and on close
+        if self.file is not None:
+            self.file.write(json.dumps(line) + "\n")
+
+    def record_header(self, manager, **kargs):
+        self.write({"kind": "header", "manager": manager, "args": kargs})
+
+    def record(self, kind, *args):
+        self.write({"t": round(time.perf_counter() - self.start, 4), "kind": kind, "args": [to_json(a) for a in args]})
+
+    def saving(self, save_file):
+        # the save is written through this, so it is hashed as it is written instead of being read back
+        return HashingFile(save_file)
+
+    def record_save(self, hashing_file):
+        digest = hashing_file.sha256.hexdigest()
+        self.saves.append(digest)
+        self.write({"t": round(time.perf_counter() - self.start, 4), "kind": "save", "digest": digest})
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class HashingFile(object):
+    def __init__(self, save_file):
+        self.save_file = save_file
+        self.sha256 = hashlib.sha256()
+
+    def write(self, text):
+        self.sha256.update(text.encode())
+        return self.save_file.write(text)
+
+
+def to_json(value):
+    # OpenCV callbacks may hand numpy scalars or tuples
+    if isinstance(value, (tuple, list)):
+        return [to_json(v) for v in value]
+    if hasattr(value, "item"):
+        return value.item()
+    return value
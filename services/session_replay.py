@@ -0,0 +1,118 @@
+import sys
+import json
+import time
+import tempfile
+import argparse
+from contextlib import contextmanager
+
+import numpy as np
+import cv2
+
+from services.session_recorder import SessionRecorder
+
+
+# HighGUI functions used by the managers and readers, replaced by no-ops while replaying
+HIGHGUI_FUNCTIONS = ["imshow", "namedWindow", "setMouseCallback", "createTrackbar", "setTrackbarMin",
+                     "setTrackbarMax", "setTrackbarPos", "createButton", "displayOverlay", "displayStatusBar",
+                     "destroyAllWindows"]
+
+
+@contextmanager
+def stubbed_highgui():
+    saved = {name: getattr(cv2, name, None) for name in HIGHGUI_FUNCTIONS + ["waitKey"]}
+    for name in HIGHGUI_FUNCTIONS:
+        setattr(cv2, name, lambda *args, **kargs: None)
+    cv2.waitKey = lambda delay=0: time.sleep(delay / 1000.) or -1
+    try:
+        yield
+    finally:
+        for name, function in saved.items():
+            if function is None:
+                delattr(cv2, name)
+            else:
+                setattr(cv2, name, function)
+
+
+def read_recording(file_name):
+    with open(file_name, 'r') as recording:
+        lines = [json.loads(line) for line in recording if line.strip()]
+    if len(lines) == 0 or lines[0]["kind"] != "header":
+        raise ValueError(f"{file_name} is not a session recording")
+    return lines[0], lines[1:]
+
+
+def create_manager(header, input_file=None):
+    args = dict(header["args"])
+    if input_file is not None:
+        args["file"] = input_file
+    if header["manager"] == "TrackingManager":
+        from managers.tracking_manager import TrackingManager
+        return TrackingManager(**args)
+    from managers.detection_manager import DetectionManager
+    return DetectionManager(**args)
+
+
+def dispatch(manager, event):
+    kind, args = event["kind"], event["args"]
+    if kind == "mouse":
+        manager.mouse_callback(*args, None)
+    elif kind == "track":
+        manager.track_callback(*args)
+    elif kind == "button":
+        manager.button_callback(*args)
+    elif kind == "key":
+        manager.key_callback(*args)
+    elif kind == "reader":
+        manager.reader.signal_from_gui(args[0], value=args[1])
+
+
+def replay(recording_file, input_file=None, save_folder=None):
+    # feeds the recorded events back into a manager, returns (per kind latencies in seconds, saves identical)
+    header, events = read_recording(recording_file)
+    recorded_saves = [event["digest"] for event in events if event["kind"] == "save"]
+
+    latencies = {}
+    with stubbed_highgui():
+        manager = create_manager(header, input_file)
+        manager.save_folder = save_folder if save_folder is not None else tempfile.mkdtemp()
+        manager.recorder = SessionRecorder()
+        # events are replayed on the fully loaded stack, whatever was still loading while recording
+        while not manager.reader.loaded and manager.reader.error is None:
+            time.sleep(0.01)
+        manager.prepare_frame()
+
+        for event in events:
+            if event["kind"] == "save":
+                continue
+            start = time.perf_counter()
+            try:
+                dispatch(manager, event)
+            except SystemExit:
+                # the quit button
+                break
+            finally:
+                latencies.setdefault(event["kind"], []).append(time.perf_counter() - start)
+
+    return latencies, manager.recorder.saves == recorded_saves
+
+
+def latency_report(latencies):
+    lines = [f"{'event':<8}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+    for kind, values in sorted(latencies.items()):
+        values = np.array(values) * 1000.
+        lines.append(f"{kind:<8}{len(values):>8}{values.mean():>10.2f}{np.percentile(values, 50):>10.2f}"
+                     f"{np.percentile(values, 95):>10.2f}{values.max():>10.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded annotation session without GUI")
+    parser.add_argument("recording", help="file written with main.py --record")
+    parser.add_argument("--input", help="file/folder to use instead of the recorded one")
+    parser.add_argument("--save-folder", help="where the replayed saves are written (temporary folder by default)")
+    args = parser.parse_args()
+
+    latencies, identical = replay(args.recording, args.input, args.save_folder)
+    print(latency_report(latencies))
+    print(f"saved outputs identical : {identical}")
+    sys.exit(0 if identical else 1)
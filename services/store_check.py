@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+import multiprocessing
+
+from services.project_store import ProjectStore
+
+
+BOX = {"rect": {"start": (1, 2), "end": (10, 20)}}
+
+
+def annotate(project, annotator, frame_count, claim_size, claim_timeout, crash_after=None):
+    # a DetectionManager like annotator : claims chunks, commits every frame, gives back the rest on quit
+    store = ProjectStore(project, annotator=annotator, claim_timeout=claim_timeout)
+    frame, committed = 0, 0
+    while frame < frame_count:
+        first, last = store.claim_frames(frame, claim_size)
+        if first >= frame_count:
+            break
+        for frame in range(first, min(last, frame_count - 1) + 1):
+            store.commit_detections(frame, f"timestamp_{frame}", [BOX])
+            committed += 1
+            if committed == crash_after:
+                # no release, the claim stays until it expires
+                os._exit(0)
+        frame = last + 1
+    store.release_frames(frame)
+    store.close()
+
+
+def commit_tracks(project, annotator, track_count):
+    store = ProjectStore(project, annotator=annotator)
+    for local_id in store.new_local_ids(track_count):
+        store.commit_track(local_id, {0: BOX, 1: BOX})
+    store.close()
+
+
+def run(target, *args_list):
+    processes = [multiprocessing.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def check(project, annotators=3, frame_count=300, claim_size=20, claim_timeout=1.):
+    # returns the failures, several processes share the project like annotators on different machines
+    failures = []
+
+    # an annotator crashes after 5 frames, the rest of its chunk is claimed until claim_timeout
+    run(annotate, (project, "crashed", frame_count, claim_size, claim_timeout, 5))
+    probe = ProjectStore(project, annotator="probe", claim_timeout=claim_timeout)
+    if probe.claim_frames(0, claim_size)[0] != claim_size:
+        failures.append("the claim of the crashed annotator was not respected")
+    probe.release_frames()
+    time.sleep(claim_timeout * 1.5)
+    if probe.claim_frames(0, claim_size)[0] != 5:
+        failures.append("the stale claim was not taken over, or the finished frames were handed out again")
+    probe.release_frames()
+    time.sleep(claim_timeout * 1.5)
+    if probe.claim_frames(0, claim_size)[0] != 5:
+        failures.append("the finished frames expired with the claims")
+    probe.release_frames()
+
+    run(annotate, *[(project, f"annotator_{i}", frame_count, claim_size, claim_timeout) for i in range(annotators)])
+    rows = probe.connection.execute("SELECT frame, count(*), count(DISTINCT annotator) FROM boxes GROUP BY frame").fetchall()
+    if len(rows) != frame_count:
+        failures.append(f"{len(rows)} frames annotated instead of {frame_count}")
+    twice = [frame for frame, boxes, _ in rows if boxes != 1]
+    if len(twice) > 0:
+        failures.append(f"{len(twice)} frames annotated more than once (first : {twice[0]})")
+
+    # sessions sharing an annotator name never reuse a local id
+    run(commit_tracks, *[(project, "alice", 20) for _ in range(annotators)])
+    tracks = probe.connection.execute("SELECT count(DISTINCT track_id) FROM boxes WHERE annotator = 'alice'").fetchone()[0]
+    if tracks != 20 * annotators:
+        failures.append(f"{tracks} tracks kept instead of {20 * annotators}")
+    probe.close()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the project store with several annotator processes")
+    parser.add_argument("--annotators", type=int, default=3)
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+
+    check_failures = check(tempfile.mkdtemp(), args.annotators, args.frames)
+    print("ok" if len(check_failures) == 0 else "\n".join(check_failures))
+    sys.exit(0 if len(check_failures) == 0 else 1)
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+def tracks_to_arrays(cells):
+    # flattens cells ({frame: {"rect": ...}}) into arrays sorted by track then frame
+    track, frames, rects = [], [], []
+    for track_idx, cell in enumerate(cells):
+        for frame, position in cell.items():
+            track.append(track_idx)
+            frames.append(frame)
+            rect = position['rect']
+            rects.append((rect['start'][0], rect['start'][1], rect['end'][0], rect['end'][1]))
+    return sort_arrays(np.array(track, dtype=np.int64), np.array(frames, dtype=np.int64),
+                       np.array(rects, dtype=np.float64).reshape(-1, 4))
+
+
+def store_to_arrays(store):
+    # same arrays straight from a ProjectStore, track indexes are the global track ids
+    rows = store.connection.execute(
+        "SELECT track_id, frame, x0, y0, x1, y1 FROM boxes WHERE track_id IS NOT NULL ORDER BY track_id, frame"
+    ).fetchall()
+    data = np.array(rows, dtype=np.int64).reshape(-1, 6)
+    return sort_arrays(data[:, 0], data[:, 1], data[:, 2:].astype(np.float64))
+
+
+def sort_arrays(track, frames, rects):
+    order = np.lexsort((frames, track))
+    return {
+        "track": track[order],
+        "frame": frames[order],
+        "rect": rects[order]
+    }
+
+
+def robust_zscore(values, min_scale):
+    # median / MAD z-score, min_scale keeps integer boxes (often a MAD of 0) from flagging every change
+    if len(values) == 0:
+        return values
+    median = np.median(values)
+    mad = np.median(np.abs(values - median)) * 1.4826
+    return (values - median) / max(mad, min_scale)
+
+
+def compute_metrics(arrays, jump_threshold=5.0, jitter_threshold=5.0, max_gap=0, min_length=2):
+    track, frames, rects = arrays["track"], arrays["frame"], arrays["rect"]
+    track_count = int(track.max()) + 1 if len(track) > 0 else 0
+
+    centers = (rects[:, :2] + rects[:, 2:]) / 2.
+    sizes = np.maximum(rects[:, 2:] - rects[:, :2], 1.)
+
+    # a step links two consecutive boxes of the same track
+    same = track[1:] == track[:-1]
+    step_track = track[1:][same]
+    step_frame = frames[1:][same]
+    dt = (frames[1:] - frames[:-1])[same]
+    displacement = np.hypot(*(centers[1:] - centers[:-1])[same].T)
+    velocity = displacement / np.maximum(dt, 1)
+    gap = dt - 1
+    jitter = (np.abs(sizes[1:] - sizes[:-1]) / sizes[:-1])[same].sum(axis=1)
+
+    jump = robust_zscore(velocity, 1.) > jump_threshold
+    jitter_outlier = robust_zscore(jitter, 0.05) > jitter_threshold
+    gap_outlier = gap > max_gap
+
+    length = np.bincount(track, minlength=track_count)
+    step_count = np.bincount(step_track, minlength=track_count)
+    max_velocity = np.zeros(track_count)
+    np.maximum.at(max_velocity, step_track, velocity)
+
+    return {
+        "steps": {
+            "track": step_track,
+            "frame": step_frame,
+            "velocity": velocity,
+            "gap": gap,
+            "jitter": jitter,
+            "jump": jump,
+            "jitter_outlier": jitter_outlier,
+            "gap_outlier": gap_outlier
+        },
+        "tracks": {
+            "length": length,
+            "first_frame": frames[np.minimum(np.searchsorted(track, np.arange(track_count)), len(track) - 1)]
+            if len(track) > 0 else length,
+            "mean_velocity": np.bincount(step_track, velocity, track_count) / np.maximum(step_count, 1),
+            "max_velocity": max_velocity,
+            "gaps": np.bincount(step_track, gap, track_count).astype(np.int64),
+            "mean_jitter": np.bincount(step_track, jitter, track_count) / np.maximum(step_count, 1),
+            "short": (length > 0) & (length < min_length)
+        }
+    }
+
+
+def flagged_frames(metrics):
+    # (track index, frame, reason) sorted by track and frame, gaps point at their first missing frame
+    steps, tracks = metrics["steps"], metrics["tracks"]
+    flags = []
+    for reason, mask, frame in (("jump", steps["jump"], steps["frame"]),
+                                ("size jitter", steps["jitter_outlier"], steps["frame"]),
+                                ("gap", steps["gap_outlier"], steps["frame"] - steps["gap"])):
+        flags += [(t, f, reason) for t, f in zip(steps["track"][mask].tolist(), frame[mask].tolist())]
+    short = np.flatnonzero(tracks["short"])
+    flags += [(t, f, "short track") for t, f in zip(short.tolist(), tracks["first_frame"][short].tolist())]
+    return sorted(flags)